@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+"""
+Columnar tools to work on many FlexibleDate at once. Need NumPy.
+"""
+
+import datetime
+from collections import namedtuple
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from .fields import FlexibleDate, parse_flexible_date
+
+
+ParsedDates = namedtuple('ParsedDates', (
+    'year', 'month', 'day', 'precision', 'qstn', 'brkt', 'key',
+    'error', 'message_index', 'messages',
+))
+
+
+def _check_numpy():
+    if numpy is None:
+        raise ImportError('NumPy is needed to work with arrays of FlexibleDate.')
+
+
+def _to_key(value):
+    """
+    Return the tuple (key, error message) for a single value.
+    """
+    if isinstance(value, basestring):
+        try:
+            return FlexibleDate._pack(*parse_flexible_date(value)), None
+        except ValueError, e:
+            return 0, unicode(e)
+    if isinstance(value, FlexibleDate):
+        return value._key, None
+    if isinstance(value, datetime.date):
+        return FlexibleDate._date_to_key(value), None
+    return 0, u'Invalid type'
+
+
+def decode_keys(keys):
+    """
+    Return the columns (year, month, day, precision, qstn, brkt) from an array
+    of packed keys. Month and day are 0 when they are not defined.
+    """
+    _check_numpy()
+    keys = numpy.asarray(keys, dtype=numpy.int64)
+    hour = keys // FlexibleDate.KEY_HOUR % 100
+    month = numpy.where(hour >= FlexibleDate.PRESC_MONTH,
+                        keys // FlexibleDate.KEY_MONTH % 100, 0)
+    day = numpy.where(hour == FlexibleDate.PRESC_DAY,
+                      keys // FlexibleDate.KEY_DAY % 100, 0)
+    return (keys // FlexibleDate.KEY_YEAR, month, day, hour,
+            keys // FlexibleDate.KEY_MINUTE % 100, keys % 100)
+
+
+def parse_many(values):
+    """
+    Parse many dates (strings, dates or FlexibleDate) at once and return a
+    ParsedDates of NumPy columns:
+     - year, month, day: parts of the date, month and day are 0 when not
+       defined;
+     - precision, qstn, brkt: the PRESC_*, QSTN_* and BRKT* codes;
+     - key: the packed sortable key (int64);
+     - error: True for rows that are not valid dates (other columns are 0);
+     - message_index: index of the error message in messages, -1 if valid;
+     - messages: tuple of the distinct error messages.
+
+    Each distinct value is parsed only once and invalid values doesn't raise.
+    """
+    _check_numpy()
+    if isinstance(values, numpy.ndarray) and values.dtype.kind in 'SU':
+        uniques, inverse = numpy.unique(values, return_inverse=True)
+    else:
+        # Values could be of mixed types, dedupe them with a dict
+        indexes = {}
+        inverse = numpy.fromiter((indexes.setdefault(value, len(indexes))
+                                  for value in values), dtype=numpy.intp)
+        uniques = sorted(indexes, key=indexes.get)
+
+    unique_keys = numpy.zeros(len(uniques), dtype=numpy.int64)
+    unique_messages = numpy.empty(len(uniques), dtype=numpy.intp)
+    messages = []
+    message_indexes = {}
+    for idx, value in enumerate(uniques):
+        key, message = _to_key(value)
+        unique_keys[idx] = key
+        if message is None:
+            unique_messages[idx] = -1
+        else:
+            unique_messages[idx] = message_indexes.setdefault(message, len(messages))
+            if unique_messages[idx] == len(messages):
+                messages.append(message)
+
+    keys = unique_keys[inverse]
+    message_index = unique_messages[inverse]
+    return ParsedDates(*(decode_keys(keys) + (keys, message_index >= 0,
+                                              message_index, tuple(messages))))
+
+
+def _bound_key(value):
+    key, message = _to_key(value)
+    if message is not None:
+        raise ValueError(message)
+    return key
+
+
+class FlexibleDateArray(object):
+    """
+    A collection of FlexibleDate stored as their packed keys in a NumPy array.
+    The keys have the same order as FlexibleDate, so sorting and range
+    selections are done directly on the integers.
+    """
+
+    def __init__(self, dates=()):
+        parsed = parse_many(dates)
+        if parsed.error.any():
+            raise ValueError(parsed.messages[parsed.message_index[parsed.error.argmax()]])
+        self.keys = parsed.key
+        self._sorted = False
+
+    @classmethod
+    def from_keys(cls, keys, sorted=False):  # @ReservedAssignment
+        """
+        Create an array directly from packed keys, without validation.
+        """
+        _check_numpy()
+        array = cls.__new__(cls)
+        array.keys = numpy.asarray(keys, dtype=numpy.int64)
+        array._sorted = sorted
+        return array
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __iter__(self):
+        for key in self.keys.tolist():
+            yield FlexibleDate._from_key(key)
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, long, numpy.integer)):
+            return FlexibleDate._from_key(int(self.keys[index]))
+        keys = self.keys[index]
+        return self.from_keys(keys, sorted=self._sorted and isinstance(index, slice)
+                              and (index.step or 1) > 0)
+
+    def __repr__(self):
+        return '<%s(%s)>' % (self.__class__.__name__,
+                             ', '.join("'%s'" % date for date in self))
+
+    def format(self, circa=None, separator=None):  # @ReservedAssignment
+        """
+        Return the list of the string representations of the dates.
+        """
+        return FlexibleDate.format_many(self.keys.tolist(), circa, separator)
+
+    def argsort(self):
+        """
+        Return the indexes that would sort the array.
+        """
+        return self.keys.argsort(kind='mergesort')
+
+    def sort(self):
+        """
+        Sort the array in place. The keys are replaced by a sorted copy, as
+        they may be shared with another array (slices, between) or with the
+        caller of from_keys.
+        """
+        if not self._sorted:
+            self.keys = numpy.sort(self.keys)
+            self._sorted = True
+
+    def sorted(self):  # @ReservedAssignment
+        """
+        Return a sorted copy of the array.
+        """
+        if self._sorted:
+            return self.from_keys(self.keys.copy(), sorted=True)
+        return self.from_keys(numpy.sort(self.keys), sorted=True)
+
+    def between(self, start=None, end=None):
+        """
+        Return the dates where start <= date <= end (like FlexibleDate
+        comparisons). Start and end could be FlexibleDate, strings or dates,
+        None for no limit. On a sorted array the range is found with a binary
+        search and the result is a view.
+        """
+        low = None if start is None else _bound_key(start)
+        high = None if end is None else _bound_key(end)
+        if self._sorted:
+            first = 0 if low is None else self.keys.searchsorted(low, 'left')
+            last = len(self.keys) if high is None else self.keys.searchsorted(high, 'right')
+            return self.from_keys(self.keys[first:last], sorted=True)
+        mask = numpy.ones(len(self.keys), dtype=bool)
+        if low is not None:
+            mask &= self.keys >= low
+        if high is not None:
+            mask &= self.keys <= high
+        return self.from_keys(self.keys[mask])
+
+    @property
+    def year(self):
+        return self.keys // FlexibleDate.KEY_YEAR
+
+    @property
+    def month(self):
+        """
+        Months, 0 when there's no month.
+        """
+        return decode_keys(self.keys)[1]
+
+    @property
+    def day(self):
+        """
+        Days, 0 when there's no day.
+        """
+        return decode_keys(self.keys)[2]
+
+    @property
+    def precision(self):
+        """
+        Precisions as strings, *year*, *month* or *day*.
+        """
+        hour = self.keys // FlexibleDate.KEY_HOUR % 100
+        return numpy.array(['year', 'month', 'day'])[(hour - FlexibleDate.PRESC_YEAR) // 4]
+
+    def count_by_period(self, years):
+        """
+        Return the tuple of arrays (first year of each period, dates count) for
+        periods of the given number of years, only for periods having dates.
+        """
+        starts = self.year // years * years
+        return numpy.unique(starts, return_counts=True)
+
+    def decade_counts(self):
+        return self.count_by_period(10)
+
+    def century_counts(self):
+        return self.count_by_period(100)
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+    A bounded mapping that discards the least recently used entries once
+    *maxsize* entries are stored. A *maxsize* of 0 disables caching.
+    Hits and misses are counted so the size can be tuned.
+    It's safe to share an instance between threads.
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        """
+        Return the value for *key* or *default* if it's not in the cache.
+        """
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            # Re-insert to mark the entry as the most recently used
+            self._data[key] = value
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        """
+        Store *value* for *key*, discarding the oldest entry if needed.
+        """
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        """
+        Remove all entries and reset counters.
+        """
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def info(self):
+        """
+        Return a dict with the cache statistics.
+        """
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+        }
+
+
+class DigestCache(object):
+    """
+    Cache of values computed from a text, keyed on the digest of the text so
+    long texts are not kept as keys. Values are kept in a local LRUCache and,
+    if *backend* is given, in a Django cache (the object or the name of one
+    of the CACHES settings) shared between processes.
+    """
+
+    def __init__(self, prefix, maxsize=1024, backend=None, timeout=None):
+        self.prefix = prefix
+        self.local = LRUCache(maxsize)
+        self.backend = backend
+        self.timeout = timeout
+        self.backend_hits = 0
+        self.backend_misses = 0
+
+    @staticmethod
+    def digest(text):
+        if isinstance(text, unicode):
+            text = text.encode('utf-8')
+        return hashlib.sha1(text).hexdigest()
+
+    def _get_backend(self):
+        if isinstance(self.backend, basestring):
+            from django.core.cache import get_cache
+            self.backend = get_cache(self.backend)
+        return self.backend
+
+    def _get(self, key):
+        value = self.local.get(key)
+        if value is not None:
+            return value
+        backend = self._get_backend()
+        if backend is not None:
+            value = backend.get('%s:%s' % (self.prefix, key))
+            if value is not None:
+                self.backend_hits += 1
+                self.local.set(key, value)
+                return value
+            self.backend_misses += 1
+        return None
+
+    def _set(self, key, value):
+        self.local.set(key, value)
+        backend = self._get_backend()
+        if backend is not None:
+            backend.set('%s:%s' % (self.prefix, key), value, self.timeout)
+
+    def get(self, text, default=None):
+        """
+        Return the value for *text* or *default* if it's not cached.
+        """
+        value = self._get(self.digest(text))
+        return default if value is None else value
+
+    def set(self, text, value):  # @ReservedAssignment
+        """
+        Store *value* for *text*.
+        """
+        self._set(self.digest(text), value)
+
+    def get_or_set(self, text, func, digest=None):
+        """
+        Return the value for *text*, calling func(text) only if it's not
+        already cached. The *digest* of the text could be given if it's
+        already known.
+        """
+        key = digest or self.digest(text)
+        value = self._get(key)
+        if value is None:
+            value = func(text)
+            self._set(key, value)
+        return value
+
+    def clear(self):
+        """
+        Remove all local entries and reset counters.
+        """
+        self.local.clear()
+        self.backend_hits = 0
+        self.backend_misses = 0
+
+    def info(self):
+        """
+        Return a dict with the cache statistics, backend_hits and
+        backend_misses count only the lookups that missed the local cache.
+        """
+        info = self.local.info()
+        info.update(backend_hits=self.backend_hits, backend_misses=self.backend_misses)
+        return info
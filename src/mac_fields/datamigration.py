@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""
+Helpers for data migrations (South or plain scripts) of mac_fields columns.
+"""
+
+import datetime
+
+from django.db import models, transaction
+
+from .fields import FlexibleDate, FlexibleDateField
+from .html import html_to_text
+
+
+def _batches(queryset, batch_size):
+    pks = list(queryset.order_by('pk').values_list('pk', flat=True))
+    for idx in xrange(0, len(pks), batch_size):
+        yield pks[idx:idx + batch_size]
+
+
+def _to_flexible_date(value):
+    if value is None or isinstance(value, FlexibleDate):
+        return value
+    if isinstance(value, (int, long)):
+        return FlexibleDate._from_key(value)
+    if isinstance(value, datetime.datetime):
+        return FlexibleDate(value, raw=True)
+    raise TypeError('Invalid type')
+
+
+def convert_flexible_dates(model, source, target, batch_size=500):
+    """
+    Copy the flexible dates of the *source* field into the *target* field of
+    all rows of *model*, converting between the datetime and integer
+    encodings. Fields could be FlexibleDateField (any storage), DateTimeField
+    or BigIntegerField, like in South frozen models.
+
+    Rows are processed in batches, one transaction and one UPDATE per
+    distinct date of each batch.
+
+    A typical migration to integer storage adds a new
+    FlexibleDateField(storage='integer'), converts the dates into it, then
+    removes the old field and renames the new one.
+    """
+    target_field = model._meta.get_field(target)
+    for pks in _batches(model._default_manager.all(), batch_size):
+        rows = {}
+        for pk, value in model._default_manager.filter(pk__in=pks).values_list('pk', source):
+            date = _to_flexible_date(value)
+            if date is not None and not isinstance(target_field, FlexibleDateField):
+                if isinstance(target_field, models.DateTimeField):
+                    date = date._date
+                else:
+                    date = date._key
+            rows.setdefault(date, []).append(pk)
+
+        with transaction.commit_on_success():
+            for value, value_pks in rows.items():
+                model._default_manager.filter(pk__in=value_pks).update(**{target: value})
+
+
+def split_search_text(model, name, batch_size=500):
+    """
+    Move the search text saved after the HTML (search_text=True) of the
+    HTMLField *name* into its own column (search_text='column'), for all rows
+    of *model*. Rows without search text get the text version of their HTML,
+    or their text when the selector of a TextOrHTMLField is off.
+
+    Rows are processed in batches, one transaction per batch.
+    """
+    field = model._meta.get_field(name)
+    columns = ['pk', name]
+    selector = getattr(field, 'selector_field', None)
+    if selector:
+        columns.append(selector)
+    for pks in _batches(model._default_manager.all(), batch_size):
+        with transaction.commit_on_success():
+            for row in model._default_manager.filter(pk__in=pks).values_list(*columns):
+                value = row[1]
+                if value:
+                    parts = value.split(field._splitter, 1)
+                    value = parts[0]
+                    if len(parts) == 2:
+                        text = parts[1]
+                    elif selector and not row[2]:
+                        text = value
+                    else:
+                        text = html_to_text(value)
+                else:
+                    text = value
+                model._default_manager.filter(pk=row[0]).update(
+                    **{name: value, field.text_field_name: text})
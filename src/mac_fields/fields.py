@@ -1,25 +1,32 @@
 # -*- coding: utf-8 -*-
 
+import calendar
 import datetime
+import multiprocessing
 import re
 import time
-from xml.etree.cElementTree import XML
-from xml.parsers.expat import ExpatError
 
 from django import forms
+from django.conf import settings
 from django.contrib.admin import options
 from django.core import exceptions, validators
 from django.db import models
 from django.utils import datetime_safe, html
-from django.utils.functional import allow_lazy
-from django.utils.safestring import mark_safe
+from django.utils.encoding import force_unicode
+from django.utils.functional import allow_lazy, cached_property
+from django.utils.safestring import SafeUnicode, mark_safe
 from django.utils.text import _replace_entity, _entity_re
 from django.utils.translation import ugettext as _
 
 from south.modelsinspector import add_introspection_rules
 
+from . import typography
+from .cache import DigestCache, LRUCache
 from .filters import adjust_typo
-from .html import html_to_text
+from .html import html_to_text, is_well_formed, tokens_to_text
+from .subclassing import SubfieldBase
+from .tokens import tokenize
+from .typography import get_rule_set
 
 
 def _local_replace_entity(match):
@@ -34,12 +41,143 @@ def unescape_entities(text):
 unescape_entities = allow_lazy(unescape_entities, unicode)
 
 
+# Search texts of HTMLField, keyed on the digest of the HTML. Set
+# MAC_FIELDS_SEARCH_TEXT_CACHE to the name of one of the CACHES to also share
+# them between processes.
+search_text_cache = DigestCache('mac_fields.search_text', maxsize=1024,
+                                backend=getattr(settings, 'MAC_FIELDS_SEARCH_TEXT_CACHE', None))
+
+# Results of the XML validation of HTMLField, keyed on the digest of the HTML
+xml_validity_cache = DigestCache('mac_fields.xml_validity', maxsize=1024)
+
+# Results of adjust_typo for the fields filter_text. Set MAC_FIELDS_TYPO_CACHE
+# to the name of one of the CACHES to also share them between processes.
+typo_cache = DigestCache('mac_fields.typo',
+                         maxsize=getattr(settings, 'MAC_FIELDS_TYPO_CACHE_SIZE', 1024),
+                         backend=getattr(settings, 'MAC_FIELDS_TYPO_CACHE', None),
+                         timeout=getattr(settings, 'MAC_FIELDS_TYPO_CACHE_TIMEOUT', None))
+
+
+def typo_fingerprint(digest, html=True, rule_set='fr'):
+    """
+    Return the fingerprint of a text for adjust_typo from its digest: the
+    digest of the digest, the mode, the rule set and the version of the rules,
+    so it fits the <name>_typo column whatever the rule set name.
+    """
+    return DigestCache.digest('%s:%d:%s:%s' % (digest, html, rule_set, typography.RULES_VERSION))
+
+
+def cached_adjust_typo(value, html=True, rule_set='fr'):
+    """
+    adjust_typo memoized in typo_cache, keyed on the fingerprint of the value.
+    """
+    key = typo_fingerprint(DigestCache.digest(value), html, rule_set)
+    return typo_cache.get_or_set(value, lambda value: adjust_typo(value, html=html, rule_set=rule_set),
+                                 digest=key)
+
+
+def prepare_html(value):
+    """
+    Standardize entities and ampersands of HTML, like HTMLField.get_prep_value.
+    """
+    return html.fix_ampersands(unescape_entities(value))
+
+
+def _is_valid_xml(value):
+    return is_well_formed(prepare_html(value))
+
+
+def is_valid_xml(value):
+    """
+    Return True if the value of an HTMLField is well-formed XML, see
+    HTMLField.validate.
+    """
+    return xml_validity_cache.get_or_set(value, _is_valid_xml)
+
+
+def is_valid_xml_many(values, workers=None, chunksize=8):
+    """
+    Return the list of is_valid_xml results of the values. Values not already
+    in xml_validity_cache are validated in a pool of *workers* processes (the
+    number of CPUs by default), 1 to validate them in this process.
+    """
+    values = list(values)
+    results = {}
+    for value in values:
+        if value not in results:
+            results[value] = xml_validity_cache.get(value)
+    todo = [value for value, valid in results.items() if valid is None]
+    if len(todo) > 1 and workers != 1:
+        pool = multiprocessing.Pool(workers)
+        try:
+            validated = pool.map(_is_valid_xml, todo, chunksize)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        validated = map(_is_valid_xml, todo)
+    for value, valid in zip(todo, validated):
+        xml_validity_cache.set(value, valid)
+        results[value] = valid
+    return [results[value] for value in values]
+
+
+class NormalizedHTML(SafeUnicode):
+    """
+    The value of an HTMLField once cleaned. The values needed to validate and
+    save it (the prepared HTML, its UTF-8 encoding, its XML validity and its
+    search text) are computed only once, when first needed.
+    """
+    html = True
+
+    @cached_property
+    def digest(self):
+        return DigestCache.digest(self)
+
+    @cached_property
+    def prepared(self):
+        return prepare_html(unicode(self))
+
+    @cached_property
+    def prepared_digest(self):
+        return DigestCache.digest(self.prepared)
+
+    @cached_property
+    def encoded(self):
+        return self.prepared.encode('utf-8')
+
+    @cached_property
+    def valid(self):
+        return xml_validity_cache.get_or_set(self, lambda value: is_well_formed(self.encoded),
+                                             self.digest)
+
+    @cached_property
+    def search_text(self):
+        return search_text_cache.get_or_set(self, lambda value: u''.join(tokens_to_text(tokenize(self))),
+                                            self.digest)
+
+
+class NormalizedText(NormalizedHTML):
+    """
+    The value of a TextOrHTMLField in text mode, it's its own search text.
+    """
+    html = False
+
+    @cached_property
+    def search_text(self):
+        return unicode(self)
+
+
 re_parent_title = re.compile(u"^(?P<article>(?:THE|The|A|An|AN|LE|Le|LA|La|LES|Les) |(?:L'|L’))(?P<title>.+)$")
 re_unparent_title = re.compile(u"^(?P<title>.+) \((?:(?P<space>THE|The|A|An|AN|LE|Le|LA|La|LES|Les)|(?P<quote>L'|L’))\)$")
 
 
 class TitleField(models.CharField):
-    __metaclass__ = models.SubfieldBase
+    __metaclass__ = SubfieldBase
+
+    def __init__(self, verbose_name=None, name=None, lazy=False, **kwargs):
+        self.lazy = lazy
+        super(TitleField, self).__init__(verbose_name, name, **kwargs)
 
     def get_prep_value(self, value):
         """
@@ -83,21 +221,69 @@ class TitleField(models.CharField):
 
 
 class HTMLField(models.TextField):
-    __metaclass__ = models.SubfieldBase
+    """
+    A TextField for an HTML fragment.
+
+    If search_text is True, the text version of the HTML is saved after the
+    HTML in the same column (separated by a splitter), so text lookups can
+    match it. With search_text='column' the text version is saved instead in
+    its own column, <name>_text. MMACManager redirects the contains,
+    icontains, search, regex and iregex lookups to it, use
+    without_search_text() not to load it (in list views for example).
+    Use datamigration.split_search_text to move existing data.
+
+    With filter_text, the value is filtered on clean by adjust_typo with the
+    'fr' rule set (filter_text=True), by adjust_typo with another rule set
+    (filter_text='en', see typography.register_rule_set) or by a function.
+
+    If typo_fingerprint is True, the fingerprint of the value filtered by
+    adjust_typo is saved in <name>_typo, so an unchanged
+    value is not filtered again. Incrementing typography.RULES_VERSION
+    invalidates all fingerprints.
+    """
+    __metaclass__ = SubfieldBase
 
     default_error_messages = {
         'invalid': _(u'Le code XHTML de ce champ est invalide.'),
     }
 
+    search_lookups = ('contains', 'icontains', 'search', 'regex', 'iregex')
+
     def __init__(self, verbose_name=None, name=None, search_text=True, xml=True,
-                 filter_text=False, **kwargs):
-        self.search_text = search_text
+                 filter_text=False, lazy=False, typo_fingerprint=False, **kwargs):
+        if isinstance(filter_text, basestring):
+            # Fail on the model definition for an unknown rule set
+            get_rule_set(filter_text)
+        self.search_column = search_text == 'column'
+        self.search_text = bool(search_text)
         self.xml = xml
         self.filter_text = filter_text
+        self.typo_fingerprint = typo_fingerprint and bool(filter_text) and not callable(filter_text)
+        self.lazy = lazy
         self._splitter = '\n<><><><><><><><>\n'
         super(HTMLField, self).__init__(verbose_name, name, **kwargs)
 
+    def contribute_to_class(self, cls, name):
+        super(HTMLField, self).contribute_to_class(cls, name)
+        # Like the FlexibleDateField bounds, only concrete models get the column
+        if self.search_column and not cls._meta.abstract:
+            cls.add_to_class(self.text_field_name,
+                             models.TextField(editable=False, null=True, blank=True))
+        if self.typo_fingerprint and not cls._meta.abstract:
+            cls.add_to_class(self.typo_field_name,
+                             models.CharField(max_length=64, editable=False, null=True, blank=True))
+
+    @property
+    def text_field_name(self):
+        return '%s_text' % self.name
+
+    @property
+    def typo_field_name(self):
+        return '%s_typo' % self.name
+
     def to_python(self, value):
+        if isinstance(value, NormalizedHTML):
+            return value
         # Remove the text part if any, only keep the HTML part
         if isinstance(value, basestring):
             return mark_safe(value.split(self._splitter, 1)[0])
@@ -106,35 +292,104 @@ class HTMLField(models.TextField):
     def validate(self, value, model_instance):
         super(HTMLField, self).validate(value, model_instance)
         if self.xml and value and value.strip():
-            try:
-                value = self.get_prep_value(value)
-                if isinstance(value, unicode):
-                    value = value.encode('utf-8')
-                XML('<root>%s</root>' % value)
-            except (ExpatError, SyntaxError):
+            if isinstance(value, NormalizedHTML):
+                valid = value.valid
+            else:
+                valid = is_valid_xml(value)
+            if not valid:
                 raise exceptions.ValidationError(self.error_messages['invalid'])
 
+    def is_html(self, model_instance):
+        """
+        Return True if the value of the model instance is HTML, not text.
+        """
+        return True
+
+    def filter_value(self, value, model_instance, html=True):
+        """
+        Return the value filtered by filter_text. With typo_fingerprint, the
+        value is returned as is if it's the last filtered value.
+        """
+        if callable(self.filter_text):
+            return self.filter_text(value)
+        rule_set = 'fr' if self.filter_text is True else self.filter_text
+        if not self.typo_fingerprint:
+            return cached_adjust_typo(value, html, rule_set)
+
+        normalized_class = NormalizedHTML if html else NormalizedText
+        if not isinstance(value, normalized_class):
+            value = normalized_class(force_unicode(value))
+        # The fingerprint is of the value as saved (prepared), so it matches
+        # the value read back from the database
+        if getattr(model_instance, self.typo_field_name) == typo_fingerprint(value.prepared_digest, html, rule_set):
+            return value
+        value = normalized_class(cached_adjust_typo(value, html, rule_set))
+        setattr(model_instance, self.typo_field_name, typo_fingerprint(value.prepared_digest, html, rule_set))
+        return value
+
     def clean(self, value, model_instance):
         if self.filter_text and value:
-            if not callable(self.filter_text):
-                self.filter_text = adjust_typo
-            value = self.filter_text(value)
+            value = self.filter_value(value, model_instance)
+        if isinstance(value, basestring) and not isinstance(value, NormalizedHTML):
+            value = NormalizedHTML(force_unicode(value))
         return super(HTMLField, self).clean(value, model_instance)
 
     def get_prep_value(self, value):
         "Standardize encoding, entities, etc."
         value = super(HTMLField, self).get_prep_value(value)
+        if isinstance(value, NormalizedHTML):
+            return value.prepared
         if isinstance(value, basestring):
-            value = html.fix_ampersands(unescape_entities(value))
+            value = prepare_html(value)
         return value
 
+    def pre_save(self, model_instance, add):
+        value = super(HTMLField, self).pre_save(model_instance, add)
+        # Carry the text mode with the value up to get_db_prep_save, the field
+        # is shared by all instances so it can't hold it.
+        if (isinstance(value, basestring) and not isinstance(value, NormalizedText)
+                and not self.is_html(model_instance)):
+            value = NormalizedText(force_unicode(value))
+        if self.search_column:
+            # The text field is saved after this one
+            text = value
+            if value and self.search_text:
+                text = self.get_search_text(value)
+            setattr(model_instance, self.text_field_name, text)
+        return value
+
+    def get_search_text(self, value):
+        """
+        Return the text version of the HTML, from search_text_cache when the
+        same HTML was already converted.
+        """
+        if isinstance(value, NormalizedHTML):
+            return value.search_text
+        return search_text_cache.get_or_set(value, html_to_text)
+
+    def expand_lookup(self, lookup_type, value):
+        """
+        Return the filter arguments on the text field for a text lookup or
+        None if there's no text field.
+        """
+        if not self.search_column or lookup_type not in self.search_lookups:
+            return None
+        return {'%s__%s' % (self.text_field_name, lookup_type): value}
+
     def get_db_prep_save(self, value, connection):
         """
         If search_text is True, add the text version after the HTML content in
         the database.
         """
-        if value and self.search_text:
-            value = self._splitter.join((value, html_to_text(value)))
+        if isinstance(value, NormalizedHTML):
+            # Reuse the prepared HTML, entities and ampersands can't span the
+            # splitter so the parts could be prepared separately.
+            prepared = value.prepared
+            if value and self.search_text and value.html and not self.search_column:
+                prepared = self._splitter.join((prepared, prepare_html(value.search_text)))
+            return self.get_db_prep_value(prepared, connection=connection, prepared=True)
+        if value and self.search_text and not self.search_column:
+            value = self._splitter.join((value, self.get_search_text(value)))
         return super(HTMLField, self).get_db_prep_save(value, connection=connection)
 
     def formfield(self, **kwargs):
@@ -147,7 +402,7 @@ class HTMLField(models.TextField):
 
 
 class TextOrHTMLField(HTMLField):
-    __metaclass__ = models.SubfieldBase
+    __metaclass__ = SubfieldBase
 
     def __init__(self, selector_field=None, verbose_name=None, name=None,
                  search_text=True, xml=True, filter_text=False, **kwargs):
@@ -159,26 +414,22 @@ class TextOrHTMLField(HTMLField):
                                               filter_text=filter_text,
                                               **kwargs)
 
+    def is_html(self, model_instance):
+        return bool(getattr(model_instance, self.selector_field))
+
     def validate(self, value, model_instance):
-        if getattr(model_instance, self.selector_field):
+        if self.is_html(model_instance):
             super(TextOrHTMLField, self).validate(value, model_instance)
         else:
-            self.search_text = False
             super(HTMLField, self).validate(value, model_instance)
 
     def clean(self, value, model_instance):
-        if getattr(model_instance, self.selector_field):
+        if self.is_html(model_instance):
             return super(TextOrHTMLField, self).clean(value, model_instance)
-        self.search_text = False
         if self.filter_text and value:
-            value = adjust_typo(value, html=False)
+            value = self.filter_value(value, model_instance, html=False)
         return super(HTMLField, self).clean(value, model_instance)
 
-    def save_form_data(self, instance, data):
-        if not getattr(instance, self.selector_field):
-            self.search_text = False
-        super(TextOrHTMLField, self).save_form_data(instance, data)
-
 
 class FlexibleDate(object):
     """
@@ -195,6 +446,11 @@ class FlexibleDate(object):
     _date value, like when you're creating a date from serialize data or from
     a database.
     """
+    __slots__ = ('_key', '_circa_text', '_separator')
+
+    # Default texts used when outputting a date
+    default_circa_text = u'ca'
+    default_separator = u'-'
 
     # Hour = Precision (year, year-month or year-month-day)
     PRESC_DAY = 16
@@ -238,6 +494,24 @@ class FlexibleDate(object):
 
     NORMAL_TIME = datetime.time(PRESC_DAY, NO_QSTN, NO_BRKT)
 
+    # Multipliers of each part in the packed key (YYYYMMDDHHMMSS)
+    KEY_YEAR = 10 ** 10
+    KEY_MONTH = 10 ** 8
+    KEY_DAY = 10 ** 6
+    KEY_HOUR = 10 ** 4
+    KEY_MINUTE = 10 ** 2
+
+    NORMAL_KEY_TIME = PRESC_DAY * KEY_HOUR + NO_QSTN * KEY_MINUTE + NO_BRKT
+
+    # Number of years before and after a circa year covered by the date
+    CIRCA_YEARS = 5
+
+    # Formatted strings, keyed on (key, circa text, separator) for __str__
+    # and on the key for isoformat
+    FORMAT_CACHE_SIZE = 10000
+    _str_cache = {}
+    _isoformat_cache = {}
+
     def __init__(self, date_input, circa=None, separator=None, raw=False):
         """
         Create a FlexibleDate from a string representing a date.
@@ -249,10 +523,11 @@ class FlexibleDate(object):
             YYYYMM
             YYYYMMDD
 
-        FlexibleDate are encoded internally in a datetime object. So they inherit
-        automatically most of the features of dates objects (comparison, etc.).
+        FlexibleDate are encoded internally in a single integer made of the
+        digits of a datetime (YYYYMMDDHHMMSS). So they sort and compare like
+        dates objects and use very little memory.
         Year, month and day are encoded directly as year, month and day of the
-        datetime object.
+        datetime.
          - When parts of the year are undefined, they are replace by zeros.
          - When parts of the month are undefined, they are replace by ones.
          - When parts of the day are undefined, they are replace by ones.
@@ -293,17 +568,17 @@ class FlexibleDate(object):
         """
 
         if isinstance(circa, basestring):
-            self.circa_text = circa
+            self._circa_text = circa
         else:
-            self.circa_text = u'ca'
+            self._circa_text = None
 
         if isinstance(separator, basestring):
-            self.separator = separator
+            self._separator = separator
         else:
-            self.separator = u'-'
+            self._separator = None
 
         if raw and isinstance(date_input, datetime.datetime):
-            # We initialize self._date directly from the datetime object
+            # We initialize self._key directly from the datetime object
             # after having check that H:M:S are valid for a FlexibleDate
             if (date_input.hour in self.PRESCS
                 and date_input.minute in self.QSTNS
@@ -315,177 +590,204 @@ class FlexibleDate(object):
                      or (date_input.hour == self.PRESC_YEAR
                          and date_input.minute not in (self.QSTN_0_DAY, self.QSTN_0_MONTH, self.QSTN_1_MONTH)
                          and date_input.second in (self.BRKTS[0], self.BRKTS[6])))):
-                self._date = date_input
+                self._key = self._pack(date_input.year, date_input.month, date_input.day,
+                                       date_input.hour, date_input.minute, date_input.second)
             else:
                 raise ValueError('Invalid Time values for a FlexibleDate')
 
         elif isinstance(date_input, datetime.date):
-            if isinstance(date_input, datetime.datetime):
-                # If it’s a datetime, keep only date information, because we
-                # want a date
-                date_input = date_input.date()
-            # Add time info to set the date without any particularities ([], ?, ...)
-            self._date = datetime.datetime.combine(date_input, self.NORMAL_TIME)
+            # Keep only date information (for datetime), without any
+            # particularities ([], ?, ...)
+            self._key = self._date_to_key(date_input)
 
         elif isinstance(date_input, basestring):
-            # Strip all whitespaces
-            date_input = re.sub(r'\s+', u'', date_input)
-
-            # Some early validations
-            if not date_input:
-                raise ValueError('Invalid date: empty string.')
-
-            # Circa and ? are exclusive
-            if u'?' in date_input and u'c' in date_input:
-                raise ValueError('Invalid date: could not have circa and ? at the same time.')
-
-            # Their should be at most one group of one or more question marks.
-            if not re.match(r'[^\?]+\?*[^\?]*$', date_input):
-                raise ValueError('Invalid date: more then one group of question marks (?).')
-
-            # Their should have only one or no square brackets pair, the opening
-            # bracket should be first and their should be at least one character
-            # between the brackets.
-            if not re.match(r'[^\[\]]*(\[[^\[\]]+\][^\[\]]*)?$', date_input):
-                raise ValueError('Invalid date: square brackets problem.')
-
-            match = re.match(r'(?P<circa>ca?)?\[?(?P<year>(?:\d{1,4}|\d{2}\?{2}|\d{3}\?|\d{4}\?))\]?(?:[/\-,.]\[?(?P<month>\d{1,2}\??)\]?(?:[/\-,.]\[?(?P<day>(?:\d{1,2}|\d{2}\??))\]?)?)?$', date_input)
-            if not match:
-                # In this case check for a date without separator (only digit and circa).
-                match = re.match(r'(?P<circa>ca? ?)?(?P<year>\d{4})(?:(?P<month>[0-1]\d)(?:(?P<day>[0-3]\d))?)?$', date_input)
-            if match:
-                circa, year, month, day = match.group('circa', 'year', 'month', 'day')
-
-                if u'[' in date_input:
-                    # Define brackets value in function of their positions
-                    # [0000]-[00]-[00]
-                    # |    | |  | |  |   [ + ]
-                    # |    | |  | |  +->    02
-                    # |    | |  | +----> 40
-                    # |    | |  +------>    04
-                    # |    | +---------> 30
-                    # |    +----------->    06
-                    # +----------------> 20
-                    #
-                    # without brackets = 50
-
-                    # Remove everything except brackets and separators
-                    # (result should be like this '[-]-')
-                    brackets_str = re.sub(r'[^\[\]/\-,.]', u'', date_input)
-                    # Compute value from the brackets positions
-                    seconds = 28 + (10 * brackets_str.index(u'[')) - (2 * brackets_str.index(u']'))
-                else:
-                    seconds = self.NO_BRKT
-
-                if circa:
-                    minutes = self.QSTN_CIRCA
-                elif u'?' not in date_input:
-                    minutes = self.NO_QSTN
-                elif u'?' in year:
-                    minutes = 18 + (2 * (year.index(u'?') - 2))
-                elif u'?' in month:
-                    minutes = 22 + (2 * month.index(u'?'))
-                else:
-                    minutes = self.QSTN_0_DAY
-
-                if len(year) > 4:
-                    year = year[:4]
-                years = int(year.replace(u'?', '0'))
-                hours = self.PRESC_YEAR
-
-                if month:
-                    if len(month) > 2:
-                        month = month[:2]
-                    months = int(month.replace(u'?', '1'))
-                    if months:
-                        hours = self.PRESC_MONTH
-                    elif seconds % 10 in (self.CLOSE_BRKT_MONTH, self.CLOSE_BRKT_DAY):
-                        raise ValueError('Invalid date: brackets not permitted around an empty month.')
-                    elif minutes == self.QSTN_0_DAY:
-                        raise ValueError('Invalid date: question marks to day not permitted after an empty month.')
-                    else:
-                        months = 1
-                else:
-                    months = 1
-
-                if day:
-                    if len(day) > 2:
-                        day = day[:2]
-                    days = int(day)
-                    if days:
-                        if hours != self.PRESC_MONTH:
-                            raise ValueError('Invalid date: cannot have a day after an empty month.')
-                        hours = self.PRESC_DAY
-                    elif seconds % 10 == self.CLOSE_BRKT_DAY:
-                        raise ValueError('Invalid date: brackets not permitted around an empty day.')
-                    elif minutes == self.QSTN_0_DAY:
-                        raise ValueError('Invalid date: question marks not permitted after an empty day.')
-                    else:
-                        days = 1
-                else:
-                    days = 1
-
-                try:
-                    self._date = datetime.datetime(years, months, days, hours, minutes, seconds)
-                except ValueError, e:
-                    raise ValueError(e)
-
-            else:
-                raise ValueError('Invalid date')
+            self._key = self._pack(*parse_flexible_date(date_input))
 
         else:
             raise TypeError('Invalid type')
 
+    @classmethod
+    def parse_many(cls, values):
+        """
+        Parse many dates at once, without raising for invalid ones, and return
+        the result in NumPy columns (see mac_fields.arrays.parse_many).
+        """
+        from .arrays import parse_many
+        return parse_many(values)
+
+    @classmethod
+    def _from_key(cls, key, circa=None, separator=None):
+        """
+        Create a FlexibleDate directly from a packed key, without validation.
+        """
+        date = cls.__new__(cls)
+        date._key = key
+        date._circa_text = circa
+        date._separator = separator
+        return date
+
+    @classmethod
+    def _pack(cls, year, month, day, hour, minute, second):
+        return (year * cls.KEY_YEAR + month * cls.KEY_MONTH + day * cls.KEY_DAY
+                + hour * cls.KEY_HOUR + minute * cls.KEY_MINUTE + second)
+
+    @classmethod
+    def _date_to_key(cls, date):
+        return (date.year * cls.KEY_YEAR + date.month * cls.KEY_MONTH
+                + date.day * cls.KEY_DAY + cls.NORMAL_KEY_TIME)
+
+    def _unpack(self):
+        """
+        Return the tuple (year, month, day, hour, minute, second) of the key.
+        """
+        return self._unpack_key(self._key)
+
+    @classmethod
+    def _unpack_key(cls, key):
+        date, time = divmod(key, cls.KEY_DAY)
+        year, month_day = divmod(date, 10000)
+        month, day = divmod(month_day, 100)
+        hour, minute_second = divmod(time, 10000)
+        minute, second = divmod(minute_second, 100)
+        return year, month, day, hour, minute, second
+
+    def __getstate__(self):
+        return (self._key, self._circa_text, self._separator)
+
+    def __setstate__(self, state):
+        if isinstance(state, dict):
+            # Pickled before the dates were packed: the instance dict
+            date = state['_date']
+            self._key = self._pack(date.year, date.month, date.day, date.hour, date.minute, date.second)
+            circa_text = state.get('circa_text')
+            separator = state.get('separator')
+            self._circa_text = None if circa_text == self.default_circa_text else circa_text
+            self._separator = None if separator == self.default_separator else separator
+            return
+        self._key, self._circa_text, self._separator = state
+
+    @property
+    def _date(self):
+        """
+        Return the date encoded in a datetime object.
+        """
+        return datetime.datetime(*self._unpack())
+
+    @property
+    def circa_text(self):
+        if self._circa_text is None:
+            return self.default_circa_text
+        return self._circa_text
+
+    @circa_text.setter
+    def circa_text(self, value):
+        self._circa_text = value
+
+    @property
+    def separator(self):
+        if self._separator is None:
+            return self.default_separator
+        return self._separator
+
+    @separator.setter
+    def separator(self, value):
+        self._separator = value
+
     def __str__(self):
         """
         Return a string representation of the date, showing only parts that
         are defined. Ex.: if there's no day the output will be YYYY-MM.
         """
+        cache_key = (self._key, self._circa_text, self._separator)
+        try:
+            return self._str_cache[cache_key]
+        except KeyError:
+            date_str = self._format(self._key, self.circa_text, self.separator)
+            self._cache_set(self._str_cache, cache_key, date_str)
+            return date_str
+
+    @classmethod
+    def format_many(cls, dates, circa=None, separator=None):
+        """
+        Return the list of the string representations of dates (FlexibleDate,
+        packed keys or None for an empty string), each distinct date being
+        formatted once. Circa and separator, when given, override the ones of
+        the dates.
+        """
+        formatted = {}
+        strings = []
+        for date in dates:
+            if date is None:
+                strings.append(u'')
+                continue
+            if isinstance(date, FlexibleDate):
+                key = (date._key, date.circa_text if circa is None else circa,
+                       date.separator if separator is None else separator)
+            else:
+                key = (date, cls.default_circa_text if circa is None else circa,
+                       cls.default_separator if separator is None else separator)
+            try:
+                strings.append(formatted[key])
+            except KeyError:
+                formatted[key] = cls._format(*key)
+                strings.append(formatted[key])
+        return strings
+
+    @staticmethod
+    def _cache_set(cache, key, value):
+        # Keep caches bounded, simply starting over when they are full
+        if len(cache) >= FlexibleDate.FORMAT_CACHE_SIZE:
+            cache.clear()
+        cache[key] = value
+
+    @classmethod
+    def _format(cls, key, circa_text, separator):
+        year, month, day, hour, minute, second = cls._unpack_key(key)
         date_str = []
-        close_bracket = self._date.second % 10
-        open_bracket = self._date.second - close_bracket
-        if self._date.minute == self.QSTN_CIRCA:
-            date_str.append(self.circa_text)
-        if open_bracket == self.OPEN_BRKT_YEAR:
+        close_bracket = second % 10
+        open_bracket = second - close_bracket
+        if minute == cls.QSTN_CIRCA:
+            date_str.append(circa_text)
+        if open_bracket == cls.OPEN_BRKT_YEAR:
             date_str.append(u'[')
 
-        year = str(self.year)
-        if self._date.minute == self.QSTN_2_YEAR:
+        year = str(year)
+        if minute == cls.QSTN_2_YEAR:
             year = '%s??' % year[:2]
-        elif self._date.minute == self.QSTN_1_YEAR:
+        elif minute == cls.QSTN_1_YEAR:
             year = '%s?' % year[:3]
-        elif self._date.minute == self.QSTN_0_YEAR:
+        elif minute == cls.QSTN_0_YEAR:
             year = '%s?' % year
         date_str.append(year)
 
-        if close_bracket == self.CLOSE_BRKT_YEAR:
+        if close_bracket == cls.CLOSE_BRKT_YEAR:
             date_str.append(u']')
-        if self._date.hour >= self.PRESC_MONTH:
-            date_str.append(self.separator)
-            if open_bracket == self.OPEN_BRKT_MONTH:
+        if hour >= cls.PRESC_MONTH:
+            date_str.append(separator)
+            if open_bracket == cls.OPEN_BRKT_MONTH:
                 date_str.append(u'[')
 
-            month = '%02d' % self.month
-            if self._date.minute == self.QSTN_1_MONTH:
+            month = '%02d' % month
+            if minute == cls.QSTN_1_MONTH:
                 month = '%s?' % month[0]
-            elif self._date.minute == self.QSTN_0_MONTH:
+            elif minute == cls.QSTN_0_MONTH:
                 month = '%s?' % month
             date_str.append(month)
 
-            if close_bracket == self.CLOSE_BRKT_MONTH:
+            if close_bracket == cls.CLOSE_BRKT_MONTH:
                 date_str.append(u']')
 
-            if self._date.hour == self.PRESC_DAY:
-                date_str.append(self.separator)
-                if open_bracket == self.OPEN_BRKT_DAY:
+            if hour == cls.PRESC_DAY:
+                date_str.append(separator)
+                if open_bracket == cls.OPEN_BRKT_DAY:
                     date_str.append(u'[')
 
-                day = '%02d' % self.day
-                if self._date.minute == self.QSTN_0_DAY:
+                day = '%02d' % day
+                if minute == cls.QSTN_0_DAY:
                     day = '%s?' % day
                 date_str.append(day)
 
-                if close_bracket == self.CLOSE_BRKT_DAY:
+                if close_bracket == cls.CLOSE_BRKT_DAY:
                     date_str.append(u']')
 
         return u''.join(date_str)
@@ -493,84 +795,97 @@ class FlexibleDate(object):
     def __repr__(self):
         return "<%s('%s')>" % (self.__class__.__name__, self.__str__())
 
+    def sort_key(self):
+        """
+        Return an integer that sort like the date, to use as key function:
+        sorted(dates, key=FlexibleDate.sort_key).
+        """
+        return self._key
+
     def _prep_cmp(self, other):
-        # try to convert string to FlexibleDate
+        """
+        Return the key of other to compare it with the date, or None if it
+        could not be compared.
+        """
+        # try to convert string (parsing are cached)
         if isinstance(other, basestring):
             try:
-                other = FlexibleDate(other)
+                return self._pack(*parse_flexible_date(other))
             except ValueError:
                 return None
         if isinstance(other, FlexibleDate):
-            return other._date
+            return other._key
         if isinstance(other, datetime.date):
-            if isinstance(other, datetime.datetime):
-                # If it’s a datetime, keep only date information, because where
-                # comparing dates
-                other = other.date()
-            # Add time info to set the date without any particularities ([], ?, ...)
-            other = datetime.datetime.combine(other, self.NORMAL_TIME)
-            return other
+            # If it’s a datetime, keep only date information, because where
+            # comparing dates, without any particularities ([], ?, ...)
+            return self._date_to_key(other)
         return None
 
     def __lt__(self, other):
+        if isinstance(other, FlexibleDate):
+            return self._key < other._key
         other = self._prep_cmp(other)
         if other is not None:
-            return self._date < other
+            return self._key < other
         raise TypeError
 
     def __le__(self, other):
         return not self.__gt__(other)
 
     def __eq__(self, other):
-        date = self._date
+        if isinstance(other, FlexibleDate):
+            return self._key == other._key
+        key = self._key
         # Compare both date without square brackets info (because brackets
         # are about validation and not value and normal date don't have this)
         if isinstance(other, datetime.date):
-            date = date.replace(second=self.NO_BRKT)
+            key += self.NO_BRKT - key % self.KEY_MINUTE
         other = self._prep_cmp(other)
         if other is not None:
-            return date == other
+            return key == other
         return False
 
     def __ne__(self, other):
         return not self.__eq__(other)
 
     def __gt__(self, other):
+        if isinstance(other, FlexibleDate):
+            return self._key > other._key
         other = self._prep_cmp(other)
         if other is not None:
-            return self._date > other
+            return self._key > other
         raise TypeError
 
     def __ge__(self, other):
         return not self.__lt__(other)
 
     def __hash__(self):
-        return self._date.__hash__()
+        return hash(self._key)
 
     @property
     def year(self):
         """
         Return the year.
         """
-        return self._date.year
+        return self._key // self.KEY_YEAR
 
     @property
     def month(self):
         """
         Return the month or None if there's no month.
         """
-        if self._date.hour < self.PRESC_MONTH:
+        if self._key // self.KEY_HOUR % 100 < self.PRESC_MONTH:
             return None
         else:
-            return self._date.month
+            return self._key // self.KEY_MONTH % 100
 
     @property
     def day(self):
         """
         Return the day or None if there's no day.
         """
-        if self._date.hour == self.PRESC_DAY:
-            return self._date.day
+        if self._key // self.KEY_HOUR % 100 == self.PRESC_DAY:
+            return self._key // self.KEY_DAY % 100
         else:
             return None
 
@@ -579,18 +894,76 @@ class FlexibleDate(object):
         """
         Return the smallest resolution of the date. Could be *year*, *month* or *day*.
         """
-        if self._date.hour == self.PRESC_DAY:
+        hour = self._key // self.KEY_HOUR % 100
+        if hour == self.PRESC_DAY:
             return 'day'
-        elif self._date.hour == self.PRESC_MONTH:
+        elif hour == self.PRESC_MONTH:
             return 'month'
         return 'year'
 
+    @property
+    def lower_bound(self):
+        """
+        Return the first day (a date object) of the period the date refer to.
+        """
+        return self._bounds()[0]
+
+    @property
+    def upper_bound(self):
+        """
+        Return the last day (a date object) of the period the date refer to.
+        """
+        return self._bounds()[1]
+
+    def _bounds(self):
+        """
+        Return the period covered by the date as a tuple of date objects.
+        A month cover the whole month, a year the whole year, 18?? the whole
+        century, 185? the whole decade and circa CIRCA_YEARS around the year.
+        """
+        year, month, day, hour, minute, _second = self._unpack()
+        first_year = last_year = year
+        if minute == self.QSTN_2_YEAR:
+            last_year = year + 99
+        elif minute == self.QSTN_1_YEAR:
+            last_year = year + 9
+        elif minute == self.QSTN_CIRCA:
+            first_year -= self.CIRCA_YEARS
+            last_year += self.CIRCA_YEARS
+        first_year = max(first_year, datetime.MINYEAR)
+        last_year = min(last_year, datetime.MAXYEAR)
+
+        if hour == self.PRESC_YEAR:
+            first_month, last_month = 1, 12
+        elif minute == self.QSTN_1_MONTH:
+            # 0? is from January to September and 1? from October to December
+            first_month, last_month = (10, 12) if month >= 10 else (1, 9)
+        else:
+            first_month = last_month = month
+
+        last_day = calendar.monthrange(last_year, last_month)[1]
+        if hour == self.PRESC_DAY:
+            # The day could be out of the range of the months of an uncertain
+            # year or month (200?-02-29, 2000-0?-31)
+            first_day = min(day, calendar.monthrange(first_year, first_month)[1])
+            last_day = min(day, last_day)
+        else:
+            first_day = 1
+
+        return (datetime.date(first_year, first_month, first_day),
+                datetime.date(last_year, last_month, last_day))
+
     def isoformat(self):
         """
         Return the partial date in a string formated to the ISO standard (YYYY-MM-DD).
         """
-        month, day = self._month_day_to_int()
-        return '%04d-%02d-%02d' % (self.year, month, day)
+        try:
+            return self._isoformat_cache[self._key]
+        except KeyError:
+            month, day = self._month_day_to_int()
+            date_str = '%04d-%02d-%02d' % (self.year, month, day)
+            self._cache_set(self._isoformat_cache, self._key, date_str)
+            return date_str
 
     def strftime(self, format):  # @ReservedAssignment
         """
@@ -605,7 +978,7 @@ class FlexibleDate(object):
         Return a *struct_time* (as return by gmtime()) for the date.
         """
         month, day = self._month_day_to_int()
-        date = self._date.date()
+        date = datetime.date(*self._unpack()[:3])
         return time.struct_time((self.year, month, day, 0, 0, 0, date.weekday(),
                                  date.toordinal() - datetime.date(self.year, 1, 1).toordinal() + 1, -1))
 
@@ -616,6 +989,147 @@ class FlexibleDate(object):
         return (0 if part is None else part for part in (self.month, self.day))
 
 
+# Year, month and day with optional square brackets around one or more parts
+# or the same without separator (only digits and circa).
+_re_flexible_date = re.compile(
+    r'(?:(?P<circa>ca?)?'
+    r'(?P<open0>\[)?(?P<year>\d{1,4}|\d{2}\?{2}|\d{3}\?|\d{4}\?)(?P<close0>\])?'
+    r'(?:[/\-,.](?P<open1>\[)?(?P<month>\d{1,2}\??)(?P<close1>\])?'
+    r'(?:[/\-,.](?P<open2>\[)?(?P<day>\d{1,2}|\d{2}\??)(?P<close2>\])?)?)?'
+    r'|(?P<packed_circa>ca?)?(?P<packed_year>\d{4})'
+    r'(?:(?P<packed_month>[0-1]\d)(?P<packed_day>[0-3]\d)?)?)$')
+
+# Parsed strings, keyed on the string without whitespaces
+_parse_cache = LRUCache(maxsize=4096)
+
+
+def parse_flexible_date(date_input):
+    """
+    Parse a FlexibleDate string and return a tuple (year, month, day,
+    precision, question marks/circa code, brackets code), the last three being
+    the hour, minute and second used to encode the date (see FlexibleDate).
+
+    Raise ValueError if the string is not a valid date. Results are cached.
+    """
+    # Strip all whitespaces
+    date_input = u''.join(date_input.split())
+    parsed = _parse_cache.get(date_input)
+    if parsed is None:
+        parsed = _parse_flexible_date(date_input)
+        _parse_cache.set(date_input, parsed)
+    return parsed
+
+
+def _parse_flexible_date(date_input):
+    # Some early validations
+    if not date_input:
+        raise ValueError('Invalid date: empty string.')
+
+    # Circa and ? are exclusive
+    if u'?' in date_input and u'c' in date_input:
+        raise ValueError('Invalid date: could not have circa and ? at the same time.')
+
+    match = _re_flexible_date.match(date_input)
+    if not match:
+        # Find out why, to report the same errors as before.
+        # Their should be at most one group of one or more question marks.
+        if not re.match(r'[^\?]+\?*[^\?]*$', date_input):
+            raise ValueError('Invalid date: more then one group of question marks (?).')
+        # Their should have only one or no square brackets pair, the opening
+        # bracket should be first and their should be at least one character
+        # between the brackets.
+        if not re.match(r'[^\[\]]*(\[[^\[\]]+\][^\[\]]*)?$', date_input):
+            raise ValueError('Invalid date: square brackets problem.')
+        raise ValueError('Invalid date')
+
+    year = match.group('year')
+    if year is not None:
+        circa, month, day = match.group('circa', 'month', 'day')
+    else:
+        circa, year, month, day = match.group('packed_circa', 'packed_year',
+                                              'packed_month', 'packed_day')
+
+    if u'?' in date_input and sum(1 for part in (year, month, day)
+                                  if part and u'?' in part) > 1:
+        raise ValueError('Invalid date: more then one group of question marks (?).')
+
+    if u'[' in date_input or u']' in date_input:
+        # Index of the parts (0: year, 1: month, 2: day) having brackets
+        opens = [idx for idx, name in enumerate(('open0', 'open1', 'open2'))
+                 if match.group(name)]
+        closes = [idx for idx, name in enumerate(('close0', 'close1', 'close2'))
+                  if match.group(name)]
+        if len(opens) != 1 or len(closes) != 1 or opens[0] > closes[0]:
+            raise ValueError('Invalid date: square brackets problem.')
+        # Define brackets value in function of their positions
+        # [0000]-[00]-[00]
+        # |    | |  | |  |   [ + ]
+        # |    | |  | |  +->    02
+        # |    | |  | +----> 40
+        # |    | |  +------>    04
+        # |    | +---------> 30
+        # |    +----------->    06
+        # +----------------> 20
+        #
+        # without brackets = 50
+        seconds = 26 + (10 * opens[0]) - (2 * closes[0])
+    else:
+        seconds = FlexibleDate.NO_BRKT
+
+    if circa:
+        minutes = FlexibleDate.QSTN_CIRCA
+    elif u'?' not in date_input:
+        minutes = FlexibleDate.NO_QSTN
+    elif u'?' in year:
+        minutes = 18 + (2 * (year.index(u'?') - 2))
+    elif u'?' in month:
+        minutes = 22 + (2 * month.index(u'?'))
+    else:
+        minutes = FlexibleDate.QSTN_0_DAY
+
+    if len(year) > 4:
+        year = year[:4]
+    years = int(year.replace(u'?', '0'))
+    hours = FlexibleDate.PRESC_YEAR
+
+    if month:
+        if len(month) > 2:
+            month = month[:2]
+        months = int(month.replace(u'?', '1'))
+        if months:
+            hours = FlexibleDate.PRESC_MONTH
+        elif seconds % 10 in (FlexibleDate.CLOSE_BRKT_MONTH, FlexibleDate.CLOSE_BRKT_DAY):
+            raise ValueError('Invalid date: brackets not permitted around an empty month.')
+        elif minutes == FlexibleDate.QSTN_0_DAY:
+            raise ValueError('Invalid date: question marks to day not permitted after an empty month.')
+        else:
+            months = 1
+    else:
+        months = 1
+
+    if day:
+        if len(day) > 2:
+            day = day[:2]
+        days = int(day)
+        if days:
+            if hours != FlexibleDate.PRESC_MONTH:
+                raise ValueError('Invalid date: cannot have a day after an empty month.')
+            hours = FlexibleDate.PRESC_DAY
+        elif seconds % 10 == FlexibleDate.CLOSE_BRKT_DAY:
+            raise ValueError('Invalid date: brackets not permitted around an empty day.')
+        elif minutes == FlexibleDate.QSTN_0_DAY:
+            raise ValueError('Invalid date: question marks not permitted after an empty day.')
+        else:
+            days = 1
+    else:
+        days = 1
+
+    # Check that the date exists (raise ValueError if not)
+    datetime.date(years, months, days)
+
+    return (years, months, days, hours, minutes, seconds)
+
+
 class FlexibleDateFormField(forms.Field):
     widget = forms.TextInput
     default_error_messages = {
@@ -646,14 +1160,63 @@ class FlexibleDateFormField(forms.Field):
 class FlexibleDateField(models.DateTimeField):
     """
     A Date Field that permit to omit the day or the day and month.
+
+    If bounds is True, the first and last day of the period covered by the date
+    (see FlexibleDate.lower_bound) are also saved in two indexed date columns,
+    <name>_lower and <name>_upper. This enable these lookups (with MMACManager):
+     - overlaps: the date period overlaps a date or a (start, end) range;
+     - within: the date period is completely inside a date or a range;
+     - contains_date: the date period completely contains a date.
+    Start and end could be FlexibleDate, strings or dates, None for no limit.
+
+    With storage='integer' the date is saved as its packed key in a BigInteger
+    column instead of a DateTime one. It's cheaper to index and load, but the
+    month, day and week_day lookups (and QuerySet.dates) are not available.
+    Use datamigration.convert_flexible_dates to convert existing data.
+
+    With lazy=True the value loaded from the database is converted to a
+    FlexibleDate only when the attribute is first read (see subclassing).
     """
-    __metaclass__ = models.SubfieldBase
+    __metaclass__ = SubfieldBase
 
     default_error_messages = {
         'invalid': _(u'Entrez une date valide (partielle ou complète, peut contenir : ?, [], ca)'),
     }
     description = _("Date (flexible)")
 
+    interval_lookups = ('overlaps', 'within', 'contains_date')
+
+    def __init__(self, verbose_name=None, name=None, bounds=False, storage='datetime',
+                 lazy=False, **kwargs):
+        if storage not in ('datetime', 'integer'):
+            raise ValueError("FlexibleDateField storage should be 'datetime' or 'integer'.")
+        self.bounds = bounds
+        self.storage = storage
+        self.lazy = lazy
+        super(FlexibleDateField, self).__init__(verbose_name, name, **kwargs)
+
+    def get_internal_type(self):
+        if self.storage == 'integer':
+            return 'BigIntegerField'
+        return super(FlexibleDateField, self).get_internal_type()
+
+    def contribute_to_class(self, cls, name):
+        super(FlexibleDateField, self).contribute_to_class(cls, name)
+        # Fields of abstract models are copied to the concrete models, so only
+        # add the bounds fields to the concrete ones.
+        if self.bounds and not cls._meta.abstract:
+            for bound_name in (self.lower_field_name, self.upper_field_name):
+                cls.add_to_class(bound_name, models.DateField(editable=False, null=True,
+                                                              blank=True, db_index=True))
+
+    @property
+    def lower_field_name(self):
+        return '%s_lower' % self.name
+
+    @property
+    def upper_field_name(self):
+        return '%s_upper' % self.name
+
     def to_python(self, value):
         if value is None or value == '':
             return None
@@ -661,6 +1224,10 @@ class FlexibleDateField(models.DateTimeField):
         if isinstance(value, FlexibleDate):
             return value
 
+        # From DB, with integer storage
+        if isinstance(value, (int, long)):
+            return FlexibleDate._from_key(value)
+
         # From deserialization
         if isinstance(value, basestring):
             value = super(FlexibleDateField, self).to_python(value)
@@ -676,22 +1243,76 @@ class FlexibleDateField(models.DateTimeField):
         if self.auto_now or (self.auto_now_add and add):
             value = FlexibleDate(datetime.date.today())
             setattr(model_instance, self.attname, value)
-            return value
         else:
-            return super(FlexibleDateField, self).pre_save(model_instance, add)
+            value = super(FlexibleDateField, self).pre_save(model_instance, add)
+        if self.bounds:
+            # Keep the bounds fields in sync (they are saved after this one)
+            lower, upper = value._bounds() if value else (None, None)
+            setattr(model_instance, self.lower_field_name, lower)
+            setattr(model_instance, self.upper_field_name, upper)
+        return value
+
+    def expand_lookup(self, lookup_type, value):
+        """
+        Return the filter arguments on the bounds fields for an interval lookup
+        or None if it's not an interval lookup.
+        """
+        if not self.bounds or lookup_type not in self.interval_lookups:
+            return None
+        if lookup_type != 'contains_date' and isinstance(value, (list, tuple)):
+            start, end = value
+        else:
+            start = end = value
+        start = None if start is None else self._to_bounds(start)[0]
+        end = None if end is None else self._to_bounds(end)[1]
+
+        if lookup_type == 'overlaps':
+            lookups = (('%s__lte' % self.lower_field_name, end),
+                       ('%s__gte' % self.upper_field_name, start))
+        elif lookup_type == 'within':
+            lookups = (('%s__gte' % self.lower_field_name, start),
+                       ('%s__lte' % self.upper_field_name, end))
+        else:
+            lookups = (('%s__lte' % self.lower_field_name, start),
+                       ('%s__gte' % self.upper_field_name, end))
+        return dict((key, date) for key, date in lookups if date is not None)
+
+    def _to_bounds(self, value):
+        if isinstance(value, basestring):
+            value = FlexibleDate(value)
+        if isinstance(value, FlexibleDate):
+            return value._bounds()
+        if isinstance(value, datetime.datetime):
+            value = value.date()
+        if isinstance(value, datetime.date):
+            return value, value
+        raise TypeError('Invalid type')
 
     def get_prep_lookup(self, lookup_type, value):
         # For get_next/get_previous reconvert value to FlexibleDate
         if lookup_type in ('gt', 'lt', 'exact') and isinstance(value, basestring):
             value = FlexibleDate(value)
+        if self.storage == 'integer' and lookup_type in ('month', 'day', 'week_day'):
+            raise TypeError("Field has invalid lookup with integer storage: %s" % lookup_type)
         return super(FlexibleDateField, self).get_prep_lookup(lookup_type, value)
 
+    def get_db_prep_lookup(self, lookup_type, value, connection, prepared=False):
+        if self.storage == 'integer' and lookup_type == 'year':
+            # All keys of the year (the lookup is done with a BETWEEN)
+            if not prepared:
+                value = self.get_prep_lookup(lookup_type, value)
+            return [value * FlexibleDate.KEY_YEAR, (value + 1) * FlexibleDate.KEY_YEAR - 1]
+        return super(FlexibleDateField, self).get_db_prep_lookup(lookup_type, value, connection,
+                                                                 prepared=prepared)
+
     def get_db_prep_value(self, value, connection, prepared=False):
         # Casts dates into the format expected by the backend
         if not prepared:
             value = self.get_prep_value(value)
         if value is None:
             return None
+        if self.storage == 'integer':
+            return value._key
         return connection.ops.value_to_db_datetime(value._date)
 
     def value_to_string(self, obj):
@@ -721,4 +1342,8 @@ options.FORMFIELD_FOR_DBFIELD_DEFAULTS[HTMLField] = {
 }
 
 # Introspection for South
-add_introspection_rules([], ["^mmac\.utils\.fields"])
+# FlexibleDateField bounds argument is not frozen on purpose, the bounds fields
+# it adds are frozen as normal fields.
+add_introspection_rules([
+    ([FlexibleDateField], [], {'storage': ['storage', {'default': 'datetime'}]}),
+], ["^mmac\.utils\.fields"])
@@ -1,12 +1,18 @@
 # -*- coding: utf-8 -*-
 
+import codecs
+import collections
+import functools
+import itertools
+import multiprocessing
 import re
 import unicodedata
 
-from django.utils.encoding import smart_unicode
+from django.utils.encoding import force_unicode, smart_unicode
 from django.utils.text import unescape_entities
 
-from typogrify.templatetags import typogrify
+from .tokens import TAG, TEXT, tokenize
+from .typography import SmartQuotes, get_rule_set
 
 
 def adjust_plural(name, items):
@@ -203,24 +209,99 @@ ligatures = (
 )
 
 
-def adjust_typo(texte, html=True):
+
+def _trie_pattern(words):
+    """
+    Return a pattern matching the words, factored like a trie so a match is
+    tried by walking down a single branch. The longest word is matched.
+    """
+    tree = {}
+    for word in words:
+        node = tree
+        for char in word:
+            node = node.setdefault(char, {})
+        node[''] = {}
+
+    def pattern(node):
+        branches = [re.escape(char) + pattern(node[char]) for char in sorted(node) if char]
+        if not branches:
+            return u''
+        if len(branches) == 1 and '' not in node:
+            return branches[0]
+        return u'(?:%s)%s' % (u'|'.join(branches), u'?' if '' in node else u'')
+    return pattern(tree)
+
+
+_ligatures = dict(ligatures)
+_re_ligature = re.compile(_trie_pattern(_ligatures))
+
+
+def replace_ligatures(text):
+    """
+    Replace OE and AE by their correct ligature, Œ and Æ, in the words of
+    ligatures, in one pass.
+    """
+    return _re_ligature.sub(lambda matches: _ligatures[matches.group(0)], text)
+
+
+# Tags that doesn't make content (not <> or self-closing tags except BR)
+_re_empty_tag = re.compile(r'<(/?[^>]*[^>/]|br /)>\Z', re.IGNORECASE)
+# Stand for a tag while processing text, it must stay a single non-space
+# character the rules don't look for
+_tag_placeholder = u'\ufffc'
+
+
+def _is_empty(tokens):
+    for kind, value in tokens:
+        if kind == TAG and not _re_empty_tag.match(value):
+            return False
+        if kind != TAG and not value.isspace():
+            return False
+    return True
+
+
+def adjust_typo(texte, html=True, rule_set='fr'):
+    rule_set = get_rule_set(rule_set)
     texte = smart_unicode(texte).strip()
-    if not texte or (html and re.match(r'(\s*<(/?[^>]*[^>/]|br /)>\s*)+$', texte, re.UNICODE | re.IGNORECASE)):
+    if not texte:
         return u''
 
+    if html:
+        tokens = list(tokenize(texte))
+        if _is_empty(tokens):
+            return u''
+    else:
+        tokens = [(TEXT, texte)]
+    return _adjust_tokens(tokens, html, rule_set, SmartQuotes()).strip()
+
+
+def _adjust_tokens(tokens, html, rule_set, quotes):
+    """
+    Adjust the typography of the tokens of a stripped text, *quotes* is the
+    SmartQuotes of the whole text.
+    """
     # TODO: add unit tests
     # TODO: in regex add code to ignore tags replacement
 
     if html:
-        # remove HTML tags before processing text
-        tokens = re.findall(u'<[^>]+>', texte)
-
-        for idx, value in enumerate(tokens):
-            texte = texte.replace(value, ']TAG%s[' % idx, 1)
+        # replace HTML tags by a placeholder character before processing text,
+        # the placeholders already in the text are kept as tags
+        tags = []
+        parts = []
+        for kind, value in tokens:
+            if kind == TAG and value != u'<>':
+                parts.append(_tag_placeholder)
+                tags.append(value)
+            else:
+                parts.append(value)
+                tags.extend([_tag_placeholder] * value.count(_tag_placeholder))
+        texte = u''.join(parts)
+    else:
+        texte = u''.join(value for kind, value in tokens)
 
     # replace OE and AE by their correct ligature, Œ and Æ.
-    for old, new in ligatures:
-        texte = texte.replace(old, new)
+    if rule_set.ligatures:
+        texte = replace_ligatures(texte)
 
 # TODO: verify if these cases are cover
 #    s/—/&#151;/g;
@@ -231,39 +312,236 @@ def adjust_typo(texte, html=True):
 #    s/—/&#151;/g;
 
     # do some typographic adjustments (mostly putting non-breaking space where needed)
-    regexs = [
-        (u'  +', u' '),  # remove more then one normal space
-        (u'  +', u' '),  # remove more then one special space
-        (u'«(\s| )+', u'«&nbsp;'),  # make space non-breaking after «
-        (u'(\s| )+»', u'&nbsp;»'),  # make space non-breaking before »
-        (u'«([^&])', u'«&nbsp;\g<1>'),  # add non-breaking space after «
-        (u'([^;])»', u'\g<1>&nbsp;»'),  # add non-breaking space before »
-        (u'(\s| )+(:|;|\?|!|$|%)', u'&nbsp;\g<2>'),  # make space non-breaking before :, ?, !, $, %
-        (u'(\d)(\s| )+(cm)', u'\g<1>&nbsp;\g<3>'),  # put non-breaking space between groups in long numbers (ex.: 23 000)
-        (u'(\d)(\s| )+(\d{3})', u'\g<1>&nbsp;\g<3>'),  # put non-breaking space between groups in long numbers (ex.: 23 000)
-        (u'(\s| )P\.(\s| )', u'\g<1>P.&nbsp;'),  # put non-breaking space after Page abbreviation
-        (u'(\s| )p\.', u'&nbsp;p.'),  # put non-breaking space before page abbreviation
-
-        (u' -- ', u' — '),  # changed 2 hyphen in a EM dash
-
-        (u'&(l|g)t;', u'&amp;\g<1>t;'),  # to keep &lt; and &gt; as entities when doing unescape_entities
-    ]
+    texte = rule_set.apply(texte, html)
 
+    # replace html tags at their good location (the rules never add or
+    # remove placeholders) and educate quotes, dashes and ellipses of the
+    # resulting tokens. Only the texts with a < (like the <sup> added by the
+    # rules) are tokenized again.
     if html:
-        regexs.extend([
-            (u'(\d)(ème|e|es)(\s| |-)', u'\g<1><sup>\g<2></sup>\g<3>'),  # put number extension in exposant (ex. 2e)
-            (u'([IVX])e(\s| )', u'\g<1><sup>e</sup>\g<2>'),  # put roman number extension in exposant (ex. Xe)
-            (u'1er(\s| |-)', u'1<sup>er</sup>\g<1>'),  # put 1 extension in exposant (ex. 1er)
-        ])
+        texts = texte.split(_tag_placeholder)
+        tokens = []
+        parts = [texts[0]]
+        for tag, text in zip(tags, texts[1:]):
+            if tag == _tag_placeholder:
+                parts.append(tag)
+            else:
+                _add_text_tokens(tokens, u''.join(parts))
+                tokens.append((TAG, tag))
+                parts = []
+            parts.append(text)
+        _add_text_tokens(tokens, u''.join(parts))
+        texte = quotes.educate_tokens(tokens)
+    else:
+        texte = quotes.educate(texte)
+    return unescape_entities(texte)
+
+
+def _add_text_tokens(tokens, text):
+    if u'<' in text:
+        tokens.extend(tokenize(text))
+    elif text:
+        tokens.append((TEXT, text))
+
+
+def _in_tag(source, position, in_tag):
+    """
+    Return True if the position of the source is after a < not closed by a >,
+    *in_tag* being the state at the start of the source.
+    """
+    tag_start = source.rfind('<', 0, position)
+    tag_end = source.rfind('>', 0, position)
+    if tag_start == tag_end:
+        return in_tag
+    return tag_start > tag_end
 
-    for old, new in regexs:
-        texte = re.sub(old, new, texte)
 
-    # replace html tags at their good location
-    if html:
-        for idx, value in enumerate(tokens):
-            texte = texte.replace(']TAG%s[' % idx, value, 1)
+def _find_cut(source, start=0, in_tag=False):
+    """
+    Return the last position, after *start* and before the last character,
+    where the source can be cut so the typographic rules never match across
+    (after a tag not followed by a », or before a new line following a period,
+    ? or !, outside of a tag), 0 if there's none.
+    """
+    tag_end = source.rfind('>', max(start - 1, 0), len(source) - 1) + 1
+    newline = source.rfind('\n', max(start, 2))
+    while True:
+        position = max(tag_end, newline)
+        if position <= 0:
+            return 0
+        if position == tag_end:
+            if (source[position - 2:position] != u'<>' and source[position] != u'\xbb'
+                    and _in_tag(source, position - 1, in_tag)):
+                return position
+            tag_end = source.rfind('>', max(start - 1, 0), position - 1) + 1
+        else:
+            if (source[position - 1] in u'.?!' and source[position - 2:position] != u'P.'
+                    and not _in_tag(source, position, in_tag)):
+                return position
+            newline = source.rfind('\n', max(start, 2), position)
+
+
+# Characters checked before a white space run cut by _find_forced_cut, and
+# kept before the new chunks (twice as many, for the runs across chunks)
+_spaces_context = 16
+_stream_context = 2 * _spaces_context
+
+_re_spaces = re.compile(u'[\\s\xa0]+')
+# What can't be before a white space run cut by _find_forced_cut: what the
+# rules match with the following space (numbers, number extensions, quotes,
+# punctuation, dashes and the first word of the ligatures with a space)
+_re_unsafe_before_spaces = re.compile(u'(?:[\\d«».,:;?!%%"\'`\\\\-]|\\d(?:e|es|ème)|[IVX]e|1er|%s)\\Z' % u'|'.join(
+    sorted(set(re.escape(word.split(u' ')[0]) for word, ligature in ligatures if u' ' in word))))
+# What can't be after it
+_re_unsafe_after_spaces = re.compile(u'[\\d«»:;?!%]|[pP]\\.')
+
+
+def _find_forced_cut(source, start=0, in_tag=False):
+    """
+    Return the last position, after *start*, of a white space run whose
+    neighbours no rule can match across, outside of a tag, 0 if there's none.
+    Used when the text has no cut found by _find_cut for too long.
+    """
+    # Search the runs by blocks from the end, the last cut is wanted
+    start = max(start, 1)
+    end = len(source)
+    while end > start:
+        block_start = max(end - 1024, start)
+        positions = []
+        for matches in _re_spaces.finditer(source, block_start):
+            position = matches.start()
+            if position >= end:
+                break
+            if (matches.end() < len(source) and not source[position - 1].isspace()
+                    and not _re_unsafe_before_spaces.search(source, max(position - _spaces_context, 0), position)
+                    and not _re_unsafe_after_spaces.match(source, matches.end())):
+                positions.append(position)
+        for position in reversed(positions):
+            if not _in_tag(source, position, in_tag):
+                return position
+        end = block_start
+    return 0
+
+
+def _split_stream(chunks, buffer_size=65536):
+    """
+    Yield the source given by chunks (unicode or UTF-8 encoded) in parts cut
+    by _find_cut, or by _find_forced_cut once more than *buffer_size*
+    characters are waiting for a cut. Only the new chunks are searched for
+    a cut.
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    pieces = []
+    size = 0
+    # End of the previous chunks, and if it's in a tag at its start
+    context = u''
+    in_tag = False
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = decoder.decode(chunk)
+        chunk = force_unicode(chunk)
+        if not chunk:
+            continue
+        source = context + chunk
+        cut = _find_cut(source, len(context), in_tag)
+        if not cut and size + len(chunk) > buffer_size:
+            # The end of the context not yielded yet can also be cut, for
+            # the white space runs across chunks
+            start = len(context) - min(size, len(context), _spaces_context) + 1
+            cut = _find_forced_cut(source, start, in_tag)
+        if cut:
+            buffer = u''.join(pieces) + chunk
+            cut += size - len(context)
+            yield buffer[:cut]
+            pieces = [buffer[cut:]]
+            size = len(pieces[0])
+        else:
+            pieces.append(chunk)
+            size += len(chunk)
+        context_start = max(len(source) - _stream_context, 0)
+        in_tag = _in_tag(source, context_start, in_tag)
+        context = source[context_start:]
+
+    pieces.append(decoder.decode('', True))
+    source = u''.join(pieces)
+    if source:
+        yield source
+
+
+def adjust_typo_stream(chunks, html=True, rule_set='fr', buffer_size=65536):
+    """
+    Generator version of adjust_typo, the text is given by chunks (unicode or
+    UTF-8 encoded) and the result is yield by chunks. The text is cut where
+    the rules can't match across (see _split_stream) and each part is adjusted
+    on its own, with the smart quotes state of the previous ones, so only
+    about *buffer_size* characters are kept in memory.
+    """
+    rule_set = get_rule_set(rule_set)
+    quotes = SmartQuotes()
+    # Output of the parts with only white space and empty tags (see
+    # adjust_typo) until the text proves to have some content
+    empty = html
+    held = []
+    # Trailing white space of the output, stripped at the end of the text
+    pending = u''
+    started = output_started = False
+    parts = _split_stream(chunks, buffer_size)
+    part = next(parts, None)
+    while part is not None:
+        following = next(parts, None)
+        if following is None:
+            part = part.rstrip()
+        if not started:
+            part = part.lstrip()
+            started = bool(part)
+        if part:
+            tokens = list(tokenize(part)) if html else [(TEXT, part)]
+            empty = empty and _is_empty(tokens)
+            held.append(_adjust_tokens(tokens, html, rule_set, quotes))
+            if not empty:
+                output = pending + u''.join(held)
+                held = []
+                if not output_started:
+                    output = output.lstrip()
+                    output_started = bool(output)
+                stripped = output.rstrip()
+                pending = output[len(stripped):]
+                if stripped:
+                    yield stripped
+        part = following
+
+
+def adjust_typo_many(textes, html=True, workers=None, chunksize=16, rule_set='fr'):
+    """
+    Yield the adjust_typo results of the texts, in order. Texts are adjusted
+    in a pool of *workers* processes (the number of CPUs by default), 1 to
+    adjust them in this process.
 
-    # do more typographic adjustments with smartypants
-    texte = typogrify.smartypants(texte)
-    return unescape_entities(texte).strip()
+    Texts are read by batches, the next batch being adjusted while the results
+    of the current one are yielded, so a large iterable (like a queryset
+    iterator) is never held in memory.
+    """
+    func = functools.partial(adjust_typo, html=html, rule_set=rule_set)
+    if workers == 1:
+        for texte in textes:
+            yield func(texte)
+        return
+
+    textes = iter(textes)
+    batch_size = chunksize * (workers or multiprocessing.cpu_count()) * 4
+    pool = multiprocessing.Pool(workers)
+    try:
+        pending = collections.deque()
+        while True:
+            batch = list(itertools.islice(textes, batch_size))
+            if batch:
+                pending.append(pool.imap(func, batch, chunksize))
+            if not pending:
+                break
+            if len(pending) > 1 or not batch:
+                for result in pending.popleft():
+                    yield result
+    finally:
+        # All results were yielded, or the generator was closed before
+        pool.terminate()
+        pool.join()
@@ -1,18 +1,21 @@
 # -*- coding: utf-8 -*-
 
 import re
+from xml.parsers import expat
 
 from django.utils.encoding import force_unicode
 from django.utils.functional import allow_lazy
 from django.utils.text import unescape_entities
 
+from .tokens import TEXT, tokenize, tokenize_stream
+
 
 _block_tags = 'address|blockquote|div|dl|h[1-6]|ol|p|pre|table|ul'
-# Replace new lines inside text by space
-_re_newline_in_text = re.compile('([^<>\s])\n([^\s<>])', flags=re.IGNORECASE)
+# Replace new lines inside text by space, outside of the UNICODE flag \s is
+# only the ASCII white space
+_re_newline_in_text = re.compile('(?<=[^<>\s])\n(?=[^\s<>])')
 # Add space after TD, TH and IMG
-_re_space = re.compile('(</(?:td|th)>|<img [^>]+ />)(\S)',
-                       flags=re.IGNORECASE | re.UNICODE)
+_re_space = re.compile('</(?:td|th)>|<img [^>]+ />', flags=re.IGNORECASE)
 # Add new line after BR, DD, DT, LI, TFOOT, TBODY, THEAD, TR
 _re_newline = re.compile('(?:<br />|</(?:dd|dt|li|tfoot|tbody|thead|tr)>)',
                          flags=re.IGNORECASE)
@@ -20,33 +23,135 @@ _re_newline = re.compile('(?:<br />|</(?:dd|dt|li|tfoot|tbody|thead|tr)>)',
 # HR, OL, P, PRE, TABLE, UL
 _re_2newlines = re.compile('(?:<hr />|</(?:%s)>)' % _block_tags,
                            flags=re.IGNORECASE)
-# Strip HTML tags
-_re_strip_html = re.compile('<[^>]*?>')
+# Last white space run followed by text, the text can't be output before we
+# know if it's part of an entity
+_re_last_spaces = re.compile('\s+\S*\Z', flags=re.UNICODE)
 # Remove superflous new lines
-_re_strip_newlines = re.compile('\n\n+')
+_re_strip_newlines = re.compile('\n\n\n+')
 # Remove superflous spaces
 _re_strip_spaces = re.compile('  +')
 
 
+def _format_text(text):
+    text = _re_strip_newlines.sub('\n\n', text)
+    text = _re_strip_spaces.sub(' ', text)
+    text = unescape_entities(text)
+    return text.replace('&amp;', '&')
+
+
+_tag_replacements = {}
+
+
+def _tag_replacement(tag):
+    """
+    Return the text that replace the tag or None if it's followed by a space.
+    """
+    if _re_newline.search(tag):
+        replacement = '\n'
+    elif _re_2newlines.search(tag):
+        replacement = '\n\n'
+    elif _re_space.search(tag):
+        replacement = None
+    else:
+        replacement = ''
+    if len(_tag_replacements) >= 10000:
+        _tag_replacements.clear()
+    _tag_replacements[tag] = replacement
+    return replacement
+
+
+def tokens_to_text(tokens, flush_size=512):
+    """
+    Yield, by chunks, the formated text from the tokens of an HTML source (see
+    tokens.tokenize). Tags are replaced by the spaces and new lines of the
+    text and new lines of the source are replaced by a space between words,
+    removed elsewhere.
+
+    Every *flush_size* tokens, the text is output up to its last white space.
+    """
+    parts = []
+    text = u''
+    started = space = False
+    for kind, value in tokens:
+        if '\n' in value:
+            value = _re_newline_in_text.sub(' ', value).replace('\n', '')
+        if kind == TEXT:
+            if not value:
+                continue
+            # Space after TD, TH and IMG, only before text
+            if space and not value[0].isspace():
+                parts.append(' ')
+            parts.append(value)
+            space = False
+        else:
+            if space:
+                parts.append(' ')
+            try:
+                replacement = _tag_replacements[value]
+            except KeyError:
+                replacement = _tag_replacement(value)
+            space = replacement is None
+            if replacement:
+                parts.append(replacement)
+
+        if len(parts) >= flush_size:
+            text += u''.join(parts)
+            parts = []
+            if not started:
+                text = text.lstrip()
+                started = bool(text)
+            matches = _re_last_spaces.search(text)
+            if matches and matches.start():
+                yield _format_text(text[:matches.start()])
+                text = text[matches.start():]
+
+    text += u''.join(parts)
+    text = text.rstrip() if started else text.strip()
+    if text:
+        yield _format_text(text)
+
+
+def html_to_text_stream(chunks):
+    """
+    Generator version of html_to_text, the HTML source is given by chunks
+    (unicode or UTF-8 encoded) and the text is yield by chunks, so the whole
+    document is never copied.
+    """
+    return tokens_to_text(tokenize_stream(chunks))
+
+
 def html_to_text(html):
     """
     Return formated text from HTML source (keeping words separated and
     completed, paragraphs and new lines). The output is supposed to be fine for
     words and phrases searches.
     """
-    text = force_unicode(html)
-    text = text.strip()
-    if text:
-        # Format HTML source to ouput readable/searchable text
-        text = _re_newline_in_text.sub('\g<1> \g<2>', text)
-        text = text.replace('\n', '')
-        text = _re_space.sub('\g<1> \g<2>', text)
-        text = _re_newline.sub('\g<0>\n', text)
-        text = _re_2newlines.sub('\g<0>\n\n', text)
-        text = _re_strip_html.sub('', text)
-        text = _re_strip_newlines.sub('\n\n', text.strip())
-        text = _re_strip_spaces.sub(' ', text)
-        text = unescape_entities(text)
-        text = text.replace('&amp;', '&')
-    return text
+    return u''.join(tokens_to_text(tokenize(force_unicode(html))))
 html_to_text = allow_lazy(html_to_text)
+
+
+def is_well_formed(html, chunk_size=65536):
+    """
+    Return True if the HTML source is well-formed XML once put inside a root
+    element. The source is fed by chunks to an expat parser that has no
+    handlers, so no tree is built.
+    """
+    parser = expat.ParserCreate()
+    try:
+        parser.Parse('<root>')
+        start = 0
+        while start < len(html):
+            end = start + chunk_size
+            chunk = html[start:end]
+            if isinstance(chunk, unicode):
+                # Don't split surrogate pairs (narrow Python builds)
+                if u'\ud800' <= chunk[-1] <= u'\udbff':
+                    end += 1
+                    chunk = html[start:end]
+                chunk = chunk.encode('utf-8')
+            parser.Parse(chunk)
+            start = end
+        parser.Parse('</root>', True)
+    except expat.ExpatError:
+        return False
+    return True
@@ -1,10 +1,28 @@
 # -*- coding: utf-8 -*-
 
 from django.db import models
+from django.db.models.fields import FieldDoesNotExist
 from django.db.models.query import QuerySet
+from django.db.models.sql.constants import LOOKUP_SEP
 from django.http import Http404
 
-from .filters import ligatures
+from .filters import replace_ligatures
+
+
+def _shadow_field_names(model):
+    """
+    Return the names of the columns kept in sync by HTMLField and
+    FlexibleDateField on save (search text, typo fingerprint and bounds).
+    """
+    names = []
+    for field in model._meta.fields:
+        if getattr(field, 'search_column', False):
+            names.append(field.text_field_name)
+        if getattr(field, 'typo_fingerprint', False):
+            names.append(field.typo_field_name)
+        if getattr(field, 'bounds', False):
+            names.extend((field.lower_field_name, field.upper_field_name))
+    return names
 
 
 class MMACQueryset(QuerySet):
@@ -13,10 +31,7 @@ class MMACQueryset(QuerySet):
             if not item or isinstance(item, str):
                 return item
             if isinstance(item, unicode):
-                if ('oe' or 'ae') in item.lower():
-                    for old, new in ligatures:
-                        item = item.replace(old, new)
-                return item.replace(u"'", u"’")
+                return replace_ligatures(item).replace(u"'", u"’")
             if isinstance(item, (list, tuple)):
                 converted_item = [convert_quote(subitem) for subitem in item]
                 if isinstance(item, tuple):
@@ -32,9 +47,60 @@ class MMACQueryset(QuerySet):
             return item
         args = convert_quote(args)
         kwargs = convert_quote(kwargs)
+        args = [self._expand_q(arg) if isinstance(arg, models.Q) else arg for arg in args]
+        kwargs = self._expand_lookups(kwargs)
 
         return super(MMACQueryset, self)._filter_or_exclude(negate, *args, **kwargs)
 
+    def _expand_lookups(self, kwargs):
+        """
+        Replace lookups that fields expand into other lookups, like the
+        interval lookups of FlexibleDateField (see expand_lookup).
+        """
+        expanded = {}
+        for key, value in kwargs.items():
+            lookups = None
+            parts = key.split(LOOKUP_SEP)
+            if len(parts) == 2:
+                try:
+                    field = self.model._meta.get_field(parts[0])
+                except FieldDoesNotExist:
+                    pass
+                else:
+                    if hasattr(field, 'expand_lookup'):
+                        lookups = field.expand_lookup(parts[1], value)
+            if lookups is None:
+                expanded[key] = value
+            else:
+                expanded.update(lookups)
+        return expanded
+
+    def _expand_q(self, node):
+        children = []
+        for child in node.children:
+            if isinstance(child, models.Q):
+                child = self._expand_q(child)
+            elif isinstance(child, tuple):
+                lookups = self._expand_lookups(dict((child,)))
+                if lookups.keys() != [child[0]]:
+                    # Keep expanded lookups together, even in a OR node
+                    child = models.Q(**lookups)
+            children.append(child)
+        node.children = children
+        return node
+
+    def without_search_text(self):
+        """
+        Don't load the search text columns of HTMLField (search_text='column'),
+        they are only used for lookups. Instances are then of a deferred class,
+        signals receivers registered for the model don't get their saves.
+        """
+        text_fields = [field.text_field_name for field in self.model._meta.fields
+                       if getattr(field, 'search_column', False)]
+        if text_fields:
+            return self.defer(*text_fields)
+        return self._clone()
+
     def get_or_none(self, *args, **kwargs):
         """
         Get the object or return None if object does not exists or more then one
@@ -63,6 +129,9 @@ class MMACManager(models.Manager):
         """
         return MMACQueryset(self.model, using=self._db)
 
+    def without_search_text(self):
+        return self.get_query_set().without_search_text()
+
     def get_or_none(self, *args, **kwargs):
         """
         Get the object or return None if object does not exists or more then one
@@ -108,11 +177,11 @@ class MMACModel(models.Model):
         quote by curlies on all fields.
         Convert empty string to None for all CharField and TextField
         that are blank, null and unique to avoid database integrity errors.
+        The columns kept in sync by the fields on save are skipped.
         """
         self._state.fields_cleaned = True
 
-        if exclude is None:
-            exclude = []
+        exclude = list(exclude or []) + _shadow_field_names(self.__class__)
 
         for field in self._meta.fields:
             if field.name in exclude:
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""
+Same as django.db.models.SubfieldBase, but fields created with lazy=True
+convert their value with to_python only when it's first read on the model
+instance, not each time it's set (like when loading rows from the database).
+"""
+
+from django.db.models.fields.subclassing import Creator
+
+
+class SubfieldBase(type):
+    """
+    A metaclass for custom Field subclasses. This ensures the model's attribute
+    has the descriptor protocol attached to it.
+    """
+    def __new__(cls, name, bases, attrs):
+        new_class = super(SubfieldBase, cls).__new__(cls, name, bases, attrs)
+        new_class.contribute_to_class = make_contrib(
+            new_class, attrs.get('contribute_to_class')
+        )
+        return new_class
+
+
+class LazyCreator(object):
+    """
+    Keep the value as it's set and convert it with to_python on the first
+    read, the result being cached on the instance.
+    """
+    def __init__(self, field):
+        self.field = field
+        self.raw_name = '_%s_raw' % field.name
+
+    def __get__(self, obj, type=None):  # @ReservedAssignment
+        if obj is None:
+            raise AttributeError('Can only be accessed via an instance.')
+        data = obj.__dict__
+        try:
+            return data[self.field.name]
+        except KeyError:
+            value = data[self.field.name] = self.field.to_python(data[self.raw_name])
+            del data[self.raw_name]
+            return value
+
+    def __set__(self, obj, value):
+        data = obj.__dict__
+        data[self.raw_name] = value
+        data.pop(self.field.name, None)
+
+
+def make_contrib(superclass, func=None):
+    """
+    Returns a suitable contribute_to_class() method for the Field subclass.
+    """
+    def contribute_to_class(self, cls, name):
+        if func:
+            func(self, cls, name)
+        else:
+            super(superclass, self).contribute_to_class(cls, name)
+        if getattr(self, 'lazy', False):
+            setattr(cls, self.name, LazyCreator(self))
+        else:
+            setattr(cls, self.name, Creator(self))
+
+    return contribute_to_class
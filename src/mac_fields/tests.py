@@ -3,13 +3,31 @@
 """
 
 import datetime
+import pickle
 
 from django.core import exceptions
+from django.core.cache import get_cache
 from django.db import models
 from django.test import TestCase
-
-from .fields import FlexibleDateField, HTMLField, TitleField
-from .fields import FlexibleDate
+from django.utils.unittest import skipIf
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from . import typography
+from .cache import DigestCache, LRUCache
+from .fields import FlexibleDateField, HTMLField, TextOrHTMLField, TitleField, search_text_cache
+from .fields import is_valid_xml, is_valid_xml_many, xml_validity_cache, NormalizedHTML
+from .fields import cached_adjust_typo, typo_cache, typo_fingerprint
+from .fields import FlexibleDate, parse_flexible_date
+from .arrays import FlexibleDateArray
+from .datamigration import convert_flexible_dates, split_search_text
+from .html import html_to_text, html_to_text_stream, is_well_formed, tokens_to_text
+from .tokens import TAG, TEXT, tokenize, tokenize_stream
+from .filters import adjust_typo, adjust_typo_many, adjust_typo_stream, replace_ligatures
+from .typography import HTML_RULES, TEXT_RULES, SmartQuotes, apply_rules, get_rule_set, set_profiling, smart_quotes
 from .models import MMACModel
 
 
@@ -135,6 +153,45 @@ class FlexibleDateTest(TestCase, ReallyEqualMixin):
         for date in dates:
             self.assertRaises(ValueError, FlexibleDate, datetime.datetime(*date), raw=True)
 
+    def test_parse(self):
+        dates = (
+            ('20??', (2000, 1, 1, 8, 18, 50)),
+            ('ca2000', (2000, 1, 1, 8, 30, 50)),
+            ('[2000?-01]', (2000, 1, 1, 12, 22, 24)),
+            ('2000-[01]-01', (2000, 1, 1, 16, 40, 34)),
+            (' 2000 - 01 -0\t3', (2000, 1, 3, 16, 40, 50)),
+            ('20000103', (2000, 1, 3, 16, 40, 50)),
+        )
+        for date, parsed in dates:
+            self.assertEqual(parse_flexible_date(date), parsed)
+
+    def test_parse_cache(self):
+        parse_flexible_date('1850-03-02')
+        self.assertEqual(parse_flexible_date(' 1850 -03-02'), (1850, 3, 2, 16, 40, 50))
+        self.assertRaises(ValueError, parse_flexible_date, '1850-02-30')
+        self.assertRaises(ValueError, parse_flexible_date, '1850-02-30')
+
+    def test_bounds(self):
+        dates = (
+            ('1850', (1850, 1, 1), (1850, 12, 31)),
+            ('1850-02', (1850, 2, 1), (1850, 2, 28)),
+            ('[1852-02]', (1852, 2, 1), (1852, 2, 29)),
+            ('1850-02-03?', (1850, 2, 3), (1850, 2, 3)),
+            ('ca1850', (1845, 1, 1), (1855, 12, 31)),
+            ('18??', (1800, 1, 1), (1899, 12, 31)),
+            ('185?', (1850, 1, 1), (1859, 12, 31)),
+            ('1850?', (1850, 1, 1), (1850, 12, 31)),
+            ('1850-0?', (1850, 1, 1), (1850, 9, 30)),
+            ('1850-1?', (1850, 10, 1), (1850, 12, 31)),
+            ('2000-0?-31', (2000, 1, 31), (2000, 9, 30)),
+            ('20??-02-29', (2000, 2, 29), (2099, 2, 28)),
+            ('200?-02-29', (2000, 2, 29), (2009, 2, 28)),
+            ('ca2000-02-29', (1995, 2, 28), (2005, 2, 28)),
+        )
+        for date, lower, upper in dates:
+            self.assertEqual(FlexibleDate(date).lower_bound, datetime.date(*lower))
+            self.assertEqual(FlexibleDate(date).upper_bound, datetime.date(*upper))
+
     def test_init_from_dates(self):
         dates = (
             (2001, 1, 1),
@@ -159,6 +216,32 @@ class FlexibleDateTest(TestCase, ReallyEqualMixin):
             except:
                 self.fail('Was not able to create FlexibleDate from datetime object: %s' % (date,))
 
+    def test_compact(self):
+        date = FlexibleDate('[2000-01]-01', circa='env.')
+        self.assertFalse(hasattr(date, '__dict__'))
+        self.assertEqual(date._key, 20000101164024)
+        self.assertEqual(date._date, datetime.datetime(2000, 1, 1, 16, 40, 24))
+        self.assertEqual(date.circa_text, 'env.')
+        self.assertEqual(date.separator, FlexibleDate.default_separator)
+        for protocol in (0, 2):
+            copy = pickle.loads(pickle.dumps(date, protocol))
+            self.assertReallyEqual(copy, date)
+            self.assertEqual(copy.circa_text, 'env.')
+
+    def test_unpickle_dict_state(self):
+        # Pickled when the date was held in the instance dict
+        old = ("ccopy_reg\n_reconstructor\np0\n(cmac_fields.fields\nFlexibleDate\np1\nc__builtin__\nobject\np2\n"
+               "Ntp3\nRp4\n(dp5\nS'circa_text'\np6\nVca\np7\nsS'separator'\np8\nV/\np9\nsS'_date'\np10\n"
+               "cdatetime\ndatetime\np11\n(S'\\x07:\\x02\\x01\\x0c(\\x18\\x00\\x00\\x00'\np12\ntp13\nRp14\nsb.")
+        date = pickle.loads(old)
+        self.assertReallyEqual(date, FlexibleDate('[1850-02]'))
+        self.assertEqual(str(date), '[1850/02]')
+        self.assertEqual(date._circa_text, None)
+        old = ('\x80\x02cmac_fields.fields\nFlexibleDate\nq\x00)\x81q\x01}q\x02(U\ncirca_textq\x03X\x02\x00\x00\x00'
+               'caq\x04U\tseparatorq\x05X\x01\x00\x00\x00-q\x06U\x05_dateq\x07cdatetime\ndatetime\nq\x08'
+               'U\n\x07:\x01\x01\x08\x1e2\x00\x00\x00q\t\x85q\nRq\x0bub.')
+        self.assertEqual(str(pickle.loads(old)), 'ca1850')
+
     def test_year(self):
         dates = (
             ('20??', 2000),
@@ -268,6 +351,17 @@ class FlexibleDateTest(TestCase, ReallyEqualMixin):
         for date in dates:
             self.assertEqual(str(FlexibleDate(date[0])), date[1])
 
+    def test_format_many(self):
+        dates = [FlexibleDate(date) for date in self.dates] + [None, FlexibleDate('ca1850', circa='env.')]
+        self.assertEqual(FlexibleDate.format_many(dates), list(self.dates) + ['', 'env.1850'])
+        dates = [FlexibleDate(date, circa='vers ', separator='/') for date in self.dates] + dates
+        self.assertEqual(FlexibleDate.format_many(dates),
+                         [u'' if date is None else unicode(date) for date in dates])
+        self.assertEqual(FlexibleDate.format_many(dates[-2:], circa='vers ', separator='/'),
+                         ['', 'vers 1850'])
+        self.assertEqual(FlexibleDate.format_many([20000101124024]), ['[2000-01]'])
+        self.assertEqual(str(dates[-1]), 'env.1850')
+
     def test_repr(self):
         self.assertEqual(repr(FlexibleDate('1932-02?')), "<FlexibleDate('1932-02?')>")
 
@@ -386,6 +480,12 @@ class FlexibleDateTest(TestCase, ReallyEqualMixin):
         self.assertFalse(datetime.date(1932, 12, 31) > FlexibleDate('1933'))
         self.assertTrue(datetime.date(1932, 1, 2) > FlexibleDate('1932, 1, 1'))
 
+    def test_sort_key(self):
+        dates = [FlexibleDate(date) for date in reversed(self.dates)]
+        self.assertEqual([str(date) for date in sorted(dates, key=FlexibleDate.sort_key)],
+                         [str(date) for date in sorted(dates)])
+        self.assertEqual([str(date) for date in sorted(dates)], list(self.dates))
+
     def test_le(self):
         self.assertTrue(FlexibleDate('1932') <= FlexibleDate('1932'))
         self.assertTrue(FlexibleDate('1932, 1, 1') <= FlexibleDate('1932, 1, 1'))
@@ -419,6 +519,140 @@ class FlexibleDateTest(TestCase, ReallyEqualMixin):
         self.assertTrue(datetime.date(1932, 1, 2) >= FlexibleDate('1932, 1, 1'))
 
 
+@skipIf(numpy is None, 'NumPy is not installed')
+class FlexibleDateParseManyTest(TestCase):
+    def test_parse_many(self):
+        dates = ['2000-01-02', '[1850]', 'bad', '1850-02-30', '[1850]', 'ca1900',
+                 datetime.date(1999, 12, 31)]
+        parsed = FlexibleDate.parse_many(dates)
+        self.assertEqual(list(parsed.year), [2000, 1850, 0, 0, 1850, 1900, 1999])
+        self.assertEqual(list(parsed.month), [1, 0, 0, 0, 0, 0, 12])
+        self.assertEqual(list(parsed.day), [2, 0, 0, 0, 0, 0, 31])
+        self.assertEqual(list(parsed.precision), [16, 8, 0, 0, 8, 8, 16])
+        self.assertEqual(list(parsed.qstn), [40, 40, 0, 0, 40, 30, 40])
+        self.assertEqual(list(parsed.brkt), [50, 26, 0, 0, 26, 50, 50])
+        self.assertEqual(list(parsed.error), [False, False, True, True, False, False, False])
+        self.assertEqual(list(parsed.message_index), [-1, -1, 0, 1, -1, -1, -1])
+        self.assertEqual(parsed.messages, (u'Invalid date', u'day is out of range for month'))
+        for idx in (0, 1, 5, 6):
+            self.assertEqual(parsed.key[idx], FlexibleDate(dates[idx])._key)
+
+    def test_parse_many_array(self):
+        parsed = FlexibleDate.parse_many(numpy.array(['2000', '200?', '2000', '']))
+        self.assertEqual(list(parsed.key), [20000101084050, 20000101082050, 20000101084050, 0])
+        self.assertEqual(parsed.messages, ('Invalid date: empty string.',))
+
+
+@skipIf(numpy is None, 'NumPy is not installed')
+class FlexibleDateArrayTest(TestCase):
+    def setUp(self):
+        self.dates = FlexibleDateArray(reversed(FlexibleDateTest.dates + ('1850', '1999-12', '1949?')))
+
+    def test_sort(self):
+        dates = self.dates.sorted()
+        self.assertEqual([str(date) for date in dates],
+                         [str(date) for date in sorted(self.dates)])
+        self.assertEqual(str(dates[0]), '1850')
+        self.assertEqual(str(dates[-1]), '2000-01-03')
+        self.assertEqual(list(self.dates.keys[self.dates.argsort()]), list(dates.keys))
+
+    def test_sort_shared_keys(self):
+        keys = list(self.dates.keys)
+        part = self.dates[2:]
+        part.sort()
+        self.assertEqual(list(self.dates.keys), keys)
+        self.assertEqual(list(part.keys), sorted(keys[2:]))
+        keys = numpy.array(keys)
+        dates = FlexibleDateArray.from_keys(keys)
+        dates.sort()
+        self.assertEqual(list(keys), list(self.dates.keys))
+
+    def test_between(self):
+        for dates in (self.dates, self.dates.sorted()):
+            self.assertEqual(sorted(str(date) for date in dates.between('1850', '1999-12')),
+                             ['1850', '1949?', '1999-12'])
+            self.assertEqual(len(dates.between('[2000]', '2000')), 2)
+            self.assertEqual(len(dates.between(end='1949?')), 2)
+            self.assertEqual(len(dates.between(datetime.date(2000, 1, 2))), 2)
+        self.assertRaises(ValueError, self.dates.between, 'bad')
+
+    def test_accessors(self):
+        dates = FlexibleDateArray(['1850', '1999-12', '2000-01-03'])
+        self.assertEqual(list(dates.year), [1850, 1999, 2000])
+        self.assertEqual(list(dates.month), [0, 12, 1])
+        self.assertEqual(list(dates.day), [0, 0, 3])
+        self.assertEqual(list(dates.precision), ['year', 'month', 'day'])
+        self.assertEqual(dates.format(separator='/'), ['1850', '1999/12', '2000/01/03'])
+
+    def test_counts(self):
+        starts, counts = self.dates.decade_counts()
+        self.assertEqual(list(starts), [1850, 1940, 1990, 2000])
+        self.assertEqual(list(counts), [1, 1, 1, 24])
+        starts, counts = self.dates.century_counts()
+        self.assertEqual(list(starts), [1800, 1900, 2000])
+        self.assertEqual(list(counts), [1, 2, 24])
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, FlexibleDateArray, ['2000', '2000-02-30'])
+
+
+class LRUCacheTest(TestCase):
+    def test_eviction(self):
+        cache = LRUCache(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(cache.info()['hits'], 3)
+        self.assertEqual(cache.info()['misses'], 1)
+
+    def test_disabled(self):
+        cache = LRUCache(maxsize=0)
+        cache.set('a', 1)
+        self.assertEqual(len(cache), 0)
+
+
+class DigestCacheTest(TestCase):
+    def test_local(self):
+        calls = []
+        cache = DigestCache('test', maxsize=10)
+        for _ in range(3):
+            self.assertEqual(cache.get_or_set(u'Œuvre', lambda text: calls.append(text) or text.upper()),
+                             u'ŒUVRE')
+        self.assertEqual(calls, [u'Œuvre'])
+        self.assertEqual(cache.info()['hits'], 2)
+        self.assertEqual(cache.info()['misses'], 1)
+
+    def test_backend(self):
+        backend = get_cache('django.core.cache.backends.locmem.LocMemCache')
+        DigestCache('test', backend=backend).get_or_set(u'abc', lambda text: u'ABC')
+        cache = DigestCache('test', backend=backend)
+        self.assertEqual(cache.get_or_set(u'abc', lambda text: self.fail()), u'ABC')
+        self.assertEqual(cache.get_or_set(u'abc', lambda text: self.fail()), u'ABC')
+        self.assertEqual(cache.info()['backend_hits'], 1)
+        self.assertEqual(cache.info()['backend_misses'], 0)
+
+    def test_search_text(self):
+        search_text_cache.clear()
+        for _ in range(2):
+            HTMLFieldsModel.objects.create(search=u'<p>Allo</p>')
+        self.assertEqual(search_text_cache.info()['misses'], 1)
+        self.assertEqual(search_text_cache.info()['hits'], 1)
+
+    def test_typo(self):
+        typo_cache.clear()
+        for _ in range(2):
+            HTMLFieldsMMACModel.objects.create(filter=u'<p>Un «oeuvre»</p>')
+        self.assertEqual(typo_cache.info()['misses'], 1)
+        self.assertEqual(typo_cache.info()['hits'], 1)
+        self.assertEqual(cached_adjust_typo(u'Le 1er tome', html=False), u'Le 1er tome')
+        self.assertEqual(cached_adjust_typo(u'Le 1er tome'), u'Le 1<sup>er</sup> tome')
+        self.assertEqual(typo_cache.info()['misses'], 3)
+
+
 class FlexibleDateFieldModBlankNull(models.Model):
     date = FlexibleDateField(blank=True, null=True)
 
@@ -564,6 +798,91 @@ def filter_text(text):
     return text.replace('e', '@')
 
 
+class FlexibleDateFieldBoundsMod(MMACModel):
+    date = FlexibleDateField(blank=True, null=True, bounds=True)
+
+
+class FlexibleDateFieldBoundsTest(TestCase):
+    def setUp(self):
+        for date in ('1840', 'ca1850', '1850-03', '1855-06-01', '18??', '1861'):
+            FlexibleDateFieldBoundsMod.objects.create(date=FlexibleDate(date))
+        FlexibleDateFieldBoundsMod.objects.create(date=None)
+
+    def query(self, *args, **kwargs):
+        return sorted(str(instance.date) for instance
+                      in FlexibleDateFieldBoundsMod.objects.filter(*args, **kwargs))
+
+    def test_bounds_saved(self):
+        instance = FlexibleDateFieldBoundsMod.objects.get(date=FlexibleDate('1850-03'))
+        self.assertEqual(instance.date_lower, datetime.date(1850, 3, 1))
+        self.assertEqual(instance.date_upper, datetime.date(1850, 3, 31))
+        instance.date = None
+        instance.save()
+        instance = FlexibleDateFieldBoundsMod.objects.get(pk=instance.pk)
+        self.assertEqual(instance.date_lower, None)
+
+    def test_overlaps(self):
+        self.assertEqual(self.query(date__overlaps=('1850', '1860')),
+                         ['1850-03', '1855-06-01', '18??', 'ca1850'])
+        self.assertEqual(self.query(date__overlaps='1861-05'), ['1861', '18??'])
+        self.assertEqual(self.query(date__overlaps=(None, '1844')), ['1840', '18??'])
+
+    def test_within(self):
+        self.assertEqual(self.query(date__within=('1850', '1860')), ['1850-03', '1855-06-01'])
+        self.assertEqual(self.query(date__within=('1840', None)),
+                         ['1840', '1850-03', '1855-06-01', '1861', 'ca1850'])
+
+    def test_contains_date(self):
+        self.assertEqual(self.query(date__contains_date=datetime.date(1850, 3, 4)),
+                         ['1850-03', '18??', 'ca1850'])
+        self.assertEqual(self.query(date__contains_date='1861'), ['1861', '18??'])
+
+    def test_q(self):
+        self.assertEqual(self.query(models.Q(date__within='1840') | models.Q(date__within='1861')),
+                         ['1840', '1861'])
+        self.assertEqual(self.query(models.Q(date__isnull=False), ~models.Q(date__overlaps='1850')),
+                         ['1840', '1855-06-01', '1861'])
+
+
+class FlexibleDateFieldIntegerMod(models.Model):
+    date = FlexibleDateField(blank=True, null=True)
+    packed = FlexibleDateField(blank=True, null=True, storage='integer')
+
+
+class FlexibleDateFieldIntegerTest(TestCase):
+    dates = FlexibleDateFieldTest.dates
+
+    def test_read(self):
+        for date in self.dates:
+            date = FlexibleDate(date)
+            instance = FlexibleDateFieldIntegerMod.objects.create(packed=date)
+            read = FlexibleDateFieldIntegerMod.objects.get(pk=instance.pk)
+            self.assertEqual(str(date), str(read.packed))
+        self.assertEqual(FlexibleDateFieldIntegerMod.objects.values_list('packed', flat=True)[0],
+                         20000101081850)
+
+    def test_query(self):
+        for date in self.dates + ('1999-12-31', '2001'):
+            FlexibleDateFieldIntegerMod.objects.create(packed=FlexibleDate(date))
+        objects = FlexibleDateFieldIntegerMod.objects
+        self.assertEqual(objects.filter(packed=FlexibleDate('2000')).count(), 1)
+        self.assertEqual(objects.filter(packed__gt=FlexibleDate('2000-01-01')).count(), 4)
+        self.assertEqual(objects.filter(packed__year=2000).count(), len(self.dates))
+        self.assertEqual([str(instance.packed) for instance in objects.order_by('packed')[:2]],
+                         ['1999-12-31', '20??'])
+        self.assertRaises(TypeError, objects.filter, packed__month=1)
+
+    def test_convert(self):
+        for date in self.dates:
+            FlexibleDateFieldIntegerMod.objects.create(date=FlexibleDate(date))
+        FlexibleDateFieldIntegerMod.objects.create()
+        convert_flexible_dates(FlexibleDateFieldIntegerMod, 'date', 'packed', batch_size=7)
+        for instance in FlexibleDateFieldIntegerMod.objects.all():
+            self.assertEqual(instance.date, instance.packed)
+            if instance.date is not None:
+                self.assertEqual(str(instance.date), str(instance.packed))
+
+
 class HTMLFieldsModel(models.Model):
     filter = HTMLField(blank=True, search_text=False, xml=False, filter_text=True)  # @ReservedAssignment
     filter_call = HTMLField(blank=True, search_text=False, xml=False, filter_text=filter_text)
@@ -649,6 +968,11 @@ class HTMLFieldTest(TestCase):
         self.assertEqual(len(results), 1)
         self.assertEqual(results[0].search, '')
 
+    def test_query_ligatures(self):
+        HTMLFieldsMMACModel(filter=u"<p>Classés ex aequo, l'œuvre</p>").save()
+        self.assertEqual(HTMLFieldsMMACModel.objects.filter(filter__contains=u'ex aequo').count(), 1)
+        self.assertEqual(HTMLFieldsMMACModel.objects.filter(filter__contains=u"l'oeuvre").count(), 1)
+
     valid_xml_text = u'Œuvre : Allo <p>les <strong>ba</strong>teaux</p> beaux & &eacute;paves.'
     invalid_xml_text = u'Œuvre : Allo <p>les <strong><em>ba</strong>te</em>aux</p> beaux.'
 
@@ -669,6 +993,295 @@ class HTMLFieldTest(TestCase):
         html = HTMLFieldsMMACModel(xml=self.invalid_xml_text)
         self.assertRaises(exceptions.ValidationError, html.full_clean)
 
+    def test_normalized(self):
+        text = u'<p>Œuvre &eacute;paves & co</p>'
+        html = HTMLFieldsMMACModel(search=text, xml=text)
+        html.save()
+        self.assertTrue(isinstance(html.xml, NormalizedHTML))
+        self.assertTrue('valid' in html.xml.__dict__)
+        self.assertTrue('prepared' in html.search.__dict__)
+        self.assertTrue('search_text' in html.search.__dict__)
+        not_cleaned = HTMLFieldsModel(search=text, xml=text)
+        not_cleaned.save()
+        for model, pk in ((HTMLFieldsMMACModel, html.pk), (HTMLFieldsModel, not_cleaned.pk)):
+            self.assertEqual(model.objects.filter(pk=pk).values_list('search', 'xml')[0],
+                             (u'<p>Œuvre épaves &amp; co</p>\n<><><><><><><><>\nŒuvre épaves &amp; co',
+                              u'<p>Œuvre épaves &amp; co</p>'))
+
+    def test_well_formed(self):
+        for chunk_size in (1, 4, 65536):
+            self.assertTrue(is_well_formed(u'<p>les <strong>ba</strong>teaux</p> é',
+                                           chunk_size=chunk_size))
+            self.assertFalse(is_well_formed(u'<p>les <strong>ba</p></strong>', chunk_size=chunk_size))
+        self.assertFalse(is_well_formed(u'a</root><root>b'))
+        self.assertTrue(is_valid_xml(self.valid_xml_text))
+        self.assertFalse(is_valid_xml(self.invalid_xml_text))
+
+    def test_valid_xml_many(self):
+        xml_validity_cache.clear()
+        values = [self.valid_xml_text, self.invalid_xml_text, u'<p>a</p>', self.valid_xml_text]
+        self.assertEqual(is_valid_xml_many(values, workers=2), [True, False, True, True])
+        self.assertEqual(xml_validity_cache.info()['size'], 3)
+        self.assertEqual(is_valid_xml_many(values, workers=1), [True, False, True, True])
+        self.assertEqual(xml_validity_cache.info()['hits'], 3)
+
+
+class TokenizeTest(TestCase):
+    html = u'<p class="a">Un < deux</p><>trois<br /> <'
+    tokens = [(TAG, u'<p class="a">'), (TEXT, u'Un '), (TAG, u'< deux</p>'), (TAG, u'<>'),
+              (TEXT, u'trois'), (TAG, u'<br />'), (TEXT, u' <')]
+
+    def test_tokenize(self):
+        self.assertEqual(list(tokenize(self.html)), self.tokens)
+        self.assertEqual(list(tokenize(u'')), [])
+
+    def test_stream(self):
+        for size in (1, 2, 5):
+            chunks = [self.html[idx:idx + size] for idx in range(0, len(self.html), size)]
+            self.assertEqual(list(tokenize_stream(chunks)), self.tokens)
+
+    def test_stream_long_text(self):
+        # A text without tags is yield by pieces cut at spaces
+        text = u'Un vers sans balise\net un autre vers\n' * 500
+        chunks = [text[idx:idx + 100] for idx in range(0, len(text), 100)]
+        tokens = list(tokenize_stream(chunks, flush_size=1000))
+        self.assertTrue(len(tokens) > 10)
+        self.assertTrue(all(kind == TEXT and len(value) < 1200 for kind, value in tokens))
+        self.assertEqual(u''.join(value for kind, value in tokens), text)
+        self.assertEqual(u''.join(tokens_to_text(tokens)), html_to_text(text))
+
+    def test_adjust_typo(self):
+        self.assertEqual(adjust_typo(u'<p> </p><br />'), u'')
+        self.assertEqual(adjust_typo(u'<p><img src="a" /></p>'), u'<p><img src="a" /></p>')
+        self.assertEqual(adjust_typo(u'<p>Un <em>«oeuvre»</em></p>'),
+                         u'<p>Un <em>«\xa0œuvre\xa0»</em></p>')
+        self.assertEqual(adjust_typo(u'<p>a \ufffc<b>»</b> \ufffc</p>'), u'<p>a \ufffc<b>\xa0»</b> \ufffc</p>')
+        rows = u'<tr><td>Tome 1</td><td>« 23 000 »</td></tr>' * 1000
+        self.assertEqual(adjust_typo(u'<table>%s</table>' % rows),
+                         u'<table>%s</table>' % rows.replace(u'« 23 000 »', u'«\xa023\xa0000\xa0»'))
+
+    def test_adjust_typo_many(self):
+        textes = [u'<p>Un «oeuvre»</p>', u'', u'Le 1er tome', u'<br />'] * 5
+        for html in (True, False):
+            expected = [adjust_typo(texte, html=html) for texte in textes]
+            self.assertEqual(list(adjust_typo_many(textes, html=html, workers=1)), expected)
+            self.assertEqual(list(adjust_typo_many(iter(textes), html=html, workers=2, chunksize=1)), expected)
+        results = adjust_typo_many(textes, workers=2, chunksize=1)
+        self.assertEqual(next(results), u'<p>Un «\xa0œuvre\xa0»</p>')
+        results.close()
+
+    def test_adjust_typo_stream(self):
+        texte = (u' <p>Un «oeuvre» de 23 000 pages.\nLe "1er" tome :</p>\n<p><em>Fin</em> !\n'
+                 u'« <code>"x"</code> »</p>\n&nbsp;')
+        for html in (True, False):
+            expected = adjust_typo(texte, html=html)
+            for size in (1, 3, 7, len(texte)):
+                chunks = [texte[i:i + size] for i in range(0, len(texte), size)]
+                self.assertEqual(u''.join(adjust_typo_stream(chunks, html=html)), expected)
+                chunks = [chunk.encode('utf-8') for chunk in chunks]
+                self.assertEqual(u''.join(adjust_typo_stream(chunks, html=html)), expected)
+        self.assertTrue(len(list(adjust_typo_stream(texte))) > 1)
+        self.assertEqual(list(adjust_typo_stream([u' <p>', u' </p> '])), [])
+        # Verse without cut points is cut at white space once the buffer is full
+        texte = u'Le 1er vers du XIXe siècle\nun curriculum vitae de 23 000 lignes\n' * 20
+        chunks = [texte[i:i + 10] for i in range(0, len(texte), 10)]
+        parts = list(adjust_typo_stream(chunks, html=False, buffer_size=50))
+        self.assertEqual(u''.join(parts), adjust_typo(texte, html=False))
+        self.assertTrue(max(len(part) for part in parts) < 100)
+        self.assertEqual(list(adjust_typo_stream([])), [])
+
+
+class TypographyTest(TestCase):
+    def test_rules(self):
+        text = u'Le  1er  tome ,  p. 12 : 23 000 ex. au XIXe siècle -- fin «  a » !'
+        self.assertEqual(apply_rules(text, TEXT_RULES),
+                         u'Le 1er tome ,&nbsp;p. 12&nbsp;: 23&nbsp;000 ex. au XIXe siècle — fin '
+                         u'«&nbsp;a&nbsp;»&nbsp;!')
+        self.assertEqual(apply_rules(text, HTML_RULES),
+                         u'Le 1<sup>er</sup> tome ,&nbsp;p. 12&nbsp;: 23&nbsp;000 ex. au XIX<sup>e</sup> siècle — fin '
+                         u'«&nbsp;a&nbsp;»&nbsp;!')
+        self.assertEqual(apply_rules(u'5 cm, &lt;', TEXT_RULES), u'5&nbsp;cm, &amp;lt;')
+        self.assertEqual(apply_rules(u'', HTML_RULES), u'')
+
+    def test_rule_sets(self):
+        text = u'<p>Un «oeuvre» : le 1er tome</p>'
+        self.assertEqual(adjust_typo(text, rule_set='fr'), u'<p>Un «\xa0œuvre\xa0»\xa0: le 1<sup>er</sup> tome</p>')
+        self.assertEqual(adjust_typo(text, rule_set='en'), u'<p>Un «oeuvre» : le 1er tome</p>')
+        self.assertRaises(ValueError, adjust_typo, text, rule_set='xx')
+
+    def test_profiling(self):
+        rule_set = get_rule_set('fr')
+        rule_set.reset_stats()
+        set_profiling(True)
+        try:
+            rule_set.apply(u'Un « oeuvre » : p. 12', html=False)
+        finally:
+            set_profiling(False)
+        stats = dict((stats['rule'], stats) for stats in rule_set.stats())
+        self.assertEqual(stats['make space non-breaking after «']['matches'], 1)
+        self.assertEqual(stats['put non-breaking space before cm']['matches'], 0)
+        self.assertEqual(stats['put 1 extension in exposant (ex. 1er)']['calls'], 0)
+        self.assertEqual(len(stats), len(HTML_RULES))
+
+    def test_smart_quotes(self):
+        self.assertEqual(smart_quotes(u'"Isn\'t" -- it... <code>"x"</code> \\"a\\" <em>\'</em>90\'s'),
+                         u'\u201cIsn\u2019t\u201d \u2014 it\u2026 <code>"x"</code> &#34;a&#34; <em>\u2018</em>90\u2019s')
+        self.assertEqual(adjust_typo(u'<p>L\'oeuvre "Bozo"</p>'), u'<p>L\u2019\u0153uvre \u201cBozo\u201d</p>')
+        text = u'<p>"a" <code>"x"</code></p>'
+        self.assertEqual(SmartQuotes().educate_tokens(tokenize(text)), smart_quotes(text))
+
+    def test_ligatures(self):
+        self.assertEqual(replace_ligatures(u'Un oeillet, une OEuvre, ex aequo ; oe, moeurs.'),
+                         u'Un œillet, une Œuvre, ex æquo ; oe, mœurs.')
+        self.assertEqual(replace_ligatures(u''), u'')
+
+
+class HTMLToTextTest(TestCase):
+    html = (u'<h1>Œuvres &amp; objets</h1>\n<p>Un texte\nsur <em>deux</em>  lignes.<br />'
+            u'Fin</p><table><tr><td>a</td><td>b</td></tr></table>')
+    text = u'Œuvres & objets\n\nUn texte sur deux lignes.\nFin\n\na b'
+
+    def test_html_to_text(self):
+        self.assertEqual(html_to_text(self.html), self.text)
+        self.assertEqual(html_to_text(u'  \n '), u'')
+        self.assertEqual(html_to_text(u'a\nb\nc'), u'a b c')
+
+    def test_stream(self):
+        for size in (1, 3, 7, 50):
+            chunks = [self.html[idx:idx + size] for idx in range(0, len(self.html), size)]
+            self.assertEqual(u''.join(html_to_text_stream(chunks)), self.text)
+        encoded = self.html.encode('utf-8')
+        chunks = [encoded[idx:idx + 5] for idx in range(0, len(encoded), 5)]
+        self.assertEqual(u''.join(html_to_text_stream(chunks)), self.text)
+        text = list(tokens_to_text(tokenize(self.html), flush_size=1))
+        self.assertEqual(u''.join(text), self.text)
+        self.assertTrue(len(text) > 1)
+
+
+class TextOrHTMLFieldModel(MMACModel):
+    is_html = models.BooleanField(default=True)
+    body = TextOrHTMLField(selector_field='is_html', blank=True, filter_text=True)
+
+
+class TextOrHTMLFieldTest(TestCase):
+    def test_mode_per_instance(self):
+        text = TextOrHTMLFieldModel.objects.create(is_html=False, body=u'Un <texte> & co')
+        html = TextOrHTMLFieldModel.objects.create(body=u'<p>Un texte</p>')
+        field = TextOrHTMLFieldModel._meta.get_field('body')
+        self.assertTrue(field.search_text)
+        values = dict(TextOrHTMLFieldModel.objects.values_list('pk', 'body'))
+        self.assertEqual(values[text.pk], u'Un <texte> &amp; co')
+        self.assertEqual(values[html.pk], u'<p>Un texte</p>\n<><><><><><><><>\nUn texte')
+        self.assertEqual(TextOrHTMLFieldModel.objects.get(pk=html.pk).body, u'<p>Un texte</p>')
+
+    def test_invalid_xml(self):
+        instance = TextOrHTMLFieldModel(body=u'<p>Un <texte></p>')
+        self.assertRaises(exceptions.ValidationError, instance.full_clean)
+        instance.is_html = False
+        instance.full_clean()
+
+
+class HTMLFieldSearchColumnModel(MMACModel):
+    search = HTMLField(blank=True, search_text='column', xml=False)
+
+
+class HTMLFieldSearchColumnTest(TestCase):
+    html = u'<p>Allo <strong>les</strong> bateaux</p>'
+
+    def test_save(self):
+        instance = HTMLFieldSearchColumnModel.objects.create(search=self.html)
+        self.assertEqual(HTMLFieldSearchColumnModel.objects.values_list('search', 'search_text')[0],
+                         (self.html, u'Allo les bateaux'))
+        read = HTMLFieldSearchColumnModel.objects.without_search_text().get(pk=instance.pk)
+        self.assertFalse('search_text' in read.__dict__)
+        self.assertEqual(read.search, self.html)
+
+    def test_save_loaded(self):
+        saved = []
+
+        def receiver(sender, instance, **kwargs):
+            saved.append(instance.pk)
+        instance = HTMLFieldSearchColumnModel.objects.create(search=self.html)
+        models.signals.post_save.connect(receiver, sender=HTMLFieldSearchColumnModel)
+        try:
+            read = HTMLFieldSearchColumnModel.objects.get(pk=instance.pk)
+            # The existence check and the update, the search text isn't read
+            with self.assertNumQueries(2):
+                read.save()
+        finally:
+            models.signals.post_save.disconnect(receiver, sender=HTMLFieldSearchColumnModel)
+        self.assertEqual(saved, [instance.pk])
+
+    def test_lookup(self):
+        HTMLFieldSearchColumnModel.objects.create(search=self.html)
+        objects = HTMLFieldSearchColumnModel.objects
+        self.assertEqual(objects.filter(search__icontains='les bateaux').count(), 1)
+        self.assertEqual(objects.filter(search__contains='strong').count(), 0)
+        self.assertEqual(objects.filter(models.Q(search__contains='Allo')).count(), 1)
+
+    def test_split(self):
+        instance = HTMLFieldSearchColumnModel.objects.create()
+        splitter = HTMLFieldSearchColumnModel._meta.get_field('search')._splitter
+        HTMLFieldSearchColumnModel.objects.filter(pk=instance.pk).update(
+            search=self.html + splitter + u'Allo les bateaux', search_text=None)
+        HTMLFieldSearchColumnModel.objects.create(search=u'<p>Bozo</p>')
+        split_search_text(HTMLFieldSearchColumnModel, 'search', batch_size=1)
+        self.assertEqual(list(HTMLFieldSearchColumnModel.objects.order_by('pk')
+                              .values_list('search', 'search_text')),
+                         [(self.html, u'Allo les bateaux'), (u'<p>Bozo</p>', u'Bozo')])
+
+
+class HTMLFieldTypoFingerprintModel(MMACModel):
+    body = HTMLField(blank=True, xml=False, filter_text=True, typo_fingerprint=True)
+    english = HTMLField(blank=True, xml=False, filter_text='en', typo_fingerprint=True)
+
+
+class HTMLFieldTypoFingerprintTest(TestCase):
+    def assertFiltered(self, instance, filtered):
+        lookups = typo_cache.info()['hits'] + typo_cache.info()['misses']
+        instance.save()
+        self.assertEqual(typo_cache.info()['hits'] + typo_cache.info()['misses'], lookups + filtered)
+
+    def test_skip(self):
+        typo_cache.clear()
+        instance = HTMLFieldTypoFingerprintModel(body=u'<p>Un «oeuvre»</p>')
+        self.assertFiltered(instance, 1)
+        self.assertEqual(instance.body, u'<p>Un «\xa0œuvre\xa0»</p>')
+        self.assertEqual(instance.body_typo, typo_fingerprint(DigestCache.digest(instance.body)))
+        self.assertFiltered(instance, 0)
+        self.assertFiltered(HTMLFieldTypoFingerprintModel.objects.get(pk=instance.pk), 0)
+        instance.body = u'<p>Un «oeuvre» !</p>'
+        self.assertFiltered(instance, 1)
+
+    def test_skip_ampersand(self):
+        # Saved as &amp;, the value read back has another digest
+        instance = HTMLFieldTypoFingerprintModel(body=u'<p>a & b</p>')
+        self.assertFiltered(instance, 1)
+        fingerprint = instance.body_typo
+        instance = HTMLFieldTypoFingerprintModel.objects.get(pk=instance.pk)
+        self.assertEqual(instance.body, u'<p>a &amp; b</p>')
+        self.assertFiltered(instance, 0)
+        self.assertFiltered(HTMLFieldTypoFingerprintModel.objects.get(pk=instance.pk), 0)
+        self.assertEqual(HTMLFieldTypoFingerprintModel.objects.get(pk=instance.pk).body_typo, fingerprint)
+
+    def test_rule_set(self):
+        instance = HTMLFieldTypoFingerprintModel.objects.create(english=u"<p>The oeuvre's  end</p>")
+        self.assertEqual(instance.english, u'<p>The oeuvre’s end</p>')
+        self.assertEqual(instance.english_typo, typo_fingerprint(DigestCache.digest(instance.english), True, 'en'))
+        self.assertRaises(ValueError, HTMLField, filter_text='xx')
+        max_length = HTMLFieldTypoFingerprintModel._meta.get_field('english_typo').max_length
+        self.assertTrue(len(typo_fingerprint(DigestCache.digest(u''), False, 'fr-long-rule-set-name' * 5)) <= max_length)
+
+    def test_rules_version(self):
+        instance = HTMLFieldTypoFingerprintModel.objects.create(body=u'<p>Un «oeuvre»</p>')
+        rules_version = typography.RULES_VERSION
+        typography.RULES_VERSION = rules_version + 1
+        try:
+            self.assertFiltered(instance, 1)
+        finally:
+            typography.RULES_VERSION = rules_version
+        self.assertFiltered(instance, 1)
+
 
 class TitleFieldsModel(models.Model):
     blank = TitleField(blank=True, max_length=255)
@@ -781,3 +1394,32 @@ class TitleFieldTest(TestCase):
                             if field == 'null' and text == '':
                                 text = None
                         self.assertEqual(getattr(new_instance, field), text)
+
+
+class LazyFieldsModel(models.Model):
+    date = FlexibleDateField(blank=True, null=True, lazy=True)
+    html = HTMLField(blank=True, search_text=True, xml=False, lazy=True)
+    title = TitleField(max_length=200, blank=True, lazy=True)
+
+
+class LazyFieldsTest(TestCase):
+    def test_deferred_conversion(self):
+        date = FlexibleDate('1850-03')
+        instance = LazyFieldsModel(date=date, title='Titre (Le)')
+        self.assertTrue(instance.__dict__['_date_raw'] is date)
+        self.assertFalse('date' in instance.__dict__)
+        self.assertEqual(str(instance.date), '1850-03')
+        self.assertFalse('_date_raw' in instance.__dict__)
+        self.assertEqual(instance.title, 'Le Titre')
+
+    def test_read(self):
+        instance = LazyFieldsModel.objects.create(date=FlexibleDate('ca1850'),
+                                                  html=u'<p>Un texte</p>',
+                                                  title='Le Titre')
+        read = LazyFieldsModel.objects.get(pk=instance.pk)
+        self.assertTrue(isinstance(read.__dict__['_date_raw'], datetime.datetime))
+        self.assertEqual(str(read.date), 'ca1850')
+        self.assertEqual(read.html, u'<p>Un texte</p>')
+        self.assertEqual(read.title, 'Le Titre')
+        read.date = None
+        self.assertEqual(read.date, None)
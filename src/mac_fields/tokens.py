@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""
+Split HTML sources in tag and text tokens. A tag is anything from a < to the
+next >, the text is everything else (including a < without a following >).
+"""
+
+import codecs
+import re
+
+from django.utils.encoding import force_unicode
+
+
+TEXT = False
+TAG = True
+
+_re_tag = re.compile(u'(<[^>]*>)')
+
+
+def tokenize(source):
+    """
+    Yield the (kind, value) tokens of the source, kind is TAG or TEXT. Text
+    tokens are never empty and never follow each other.
+    """
+    # Texts and tags alternate, starting with a text
+    kind = TAG
+    for value in _re_tag.split(source):
+        kind = not kind
+        if value:
+            yield kind, value
+
+
+def _text_cut(source):
+    """
+    Return the position of the last space of the source after its last tag,
+    where a long text can be cut in two text tokens, 0 if there's none. The
+    characters around a new line stay in the same token.
+    """
+    start = source.rfind('>') + 1
+    position = source.rfind(' ', start)
+    while position > start and source[position - 1] == '\n':
+        position = source.rfind(' ', start, position - 1)
+    return max(position, 0)
+
+
+def tokenize_stream(chunks, flush_size=65536):
+    """
+    Like tokenize but the source is given by chunks (unicode or UTF-8
+    encoded). The source is tokenized up to the start of its last tag, so
+    tokens are the same as for the whole source, when a chunk has a < (or the
+    > of a started tag). A text longer than *flush_size* is yield in many text
+    tokens, cut at spaces. Only the text after a < without a > is kept whole.
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    pieces = []
+    size = 0
+    flush_at = flush_size
+    # A < of the pending source has no > yet
+    in_tag = False
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = decoder.decode(chunk)
+        chunk = force_unicode(chunk)
+        if not chunk:
+            continue
+        pieces.append(chunk)
+        size += len(chunk)
+        if ('>' if in_tag else '<') not in chunk:
+            if in_tag or size < flush_at:
+                continue
+            source = u''.join(pieces)
+            end = _text_cut(source)
+            if not end:
+                # No space yet, wait for the next flush_size characters
+                pieces = [source]
+                flush_at = size + flush_size
+                continue
+        else:
+            source = u''.join(pieces)
+            # Cut before the start of the last tag, complete or not
+            end = source.rfind('<')
+            if end > 0:
+                end = source.find('<', source.rfind('>', 0, end) + 1)
+            in_tag = source.rfind('<') > source.rfind('>')
+            if end <= 0:
+                pieces = [source]
+                continue
+        tokens = list(tokenize(source[:end]))
+        source = source[end:]
+        # The last text could continue with a < of the next chunk
+        if tokens[-1][0] == TEXT and source.startswith('<'):
+            source = tokens.pop()[1] + source
+        pieces = [source]
+        size = len(source)
+        flush_at = flush_size
+        for token in tokens:
+            yield token
+
+    source = u''.join(pieces) + decoder.decode('', True)
+    for token in tokenize(source):
+        yield token
@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+"""
+Typographic rules of adjust_typo, compiled once, by rule sets: 'fr' (mostly
+non-breaking spaces for French) and 'en'. Other rule sets can be added with
+register_rule_set.
+
+Rules are applied in order, each on the result of the previous one. A rule can
+give the strings the text must contain for it to match, it's then skipped
+without scanning the text when none of them is found.
+
+Call set_profiling(True) to count, for each rule, the calls, the matches and
+the time spent, see RuleSet.stats.
+
+Quotes, dashes and ellipses are then educated by smart_quotes, for all rule
+sets.
+"""
+
+import re
+import time
+
+from .tokens import TAG, tokenize
+
+
+# Version of the adjust_typo rules (with filters.ligatures), increment it when
+# they change so cached results are not reused
+RULES_VERSION = 1
+
+_profiling = False
+
+
+def set_profiling(enabled):
+    """
+    Enable or disable the rules counters.
+    """
+    global _profiling
+    _profiling = enabled
+
+
+class Rule(object):
+    """
+    A regex substitution, skipped when the text contains none of *needs*.
+    """
+
+    def __init__(self, pattern, replacement, description='', needs=()):
+        self.regex = re.compile(pattern)
+        self.replacement = replacement
+        self.description = description
+        self.needs = needs
+        self.reset_stats()
+
+    def __repr__(self):
+        return '<Rule: %s>' % (self.description or self.regex.pattern)
+
+    def apply(self, text):  # @ReservedAssignment
+        if _profiling:
+            return self._apply_profiled(text)
+        if self.needs and not any(needed in text for needed in self.needs):
+            return text
+        return self.regex.sub(self.replacement, text)
+
+    def _apply_profiled(self, text):
+        start = time.time()
+        if not self.needs or any(needed in text for needed in self.needs):
+            text, matches = self.regex.subn(self.replacement, text)
+            self.matches += matches
+        self.calls += 1
+        self.time += time.time() - start
+        return text
+
+    def reset_stats(self):
+        self.calls = 0
+        self.matches = 0
+        self.time = 0.0
+
+    def stats(self):
+        return {
+            'rule': self.description or self.regex.pattern,
+            'calls': self.calls,
+            'matches': self.matches,
+            'time': self.time,
+        }
+
+
+def apply_rules(text, rules):
+    for rule in rules:
+        text = rule.apply(text)
+    return text
+
+
+class RuleSet(object):
+    """
+    The rules of adjust_typo for a language: *rules* for text and HTML,
+    *html_rules* applied after them only for HTML, and if OE and AE are
+    replaced by their ligatures (filters.ligatures).
+    """
+
+    def __init__(self, name, rules, html_rules=(), ligatures=False):
+        self.name = name
+        self.rules = tuple(rules)
+        self.html_rules = self.rules + tuple(html_rules)
+        self.ligatures = ligatures
+
+    def __repr__(self):
+        return '<RuleSet: %s>' % self.name
+
+    def apply(self, text, html=True):  # @ReservedAssignment
+        return apply_rules(text, self.html_rules if html else self.rules)
+
+    def reset_stats(self):
+        for rule in self.html_rules:
+            rule.reset_stats()
+
+    def stats(self):
+        """
+        Return the counters of the rules, the most time consuming first.
+        """
+        return sorted((rule.stats() for rule in self.html_rules), key=lambda stats: -stats['time'])
+
+
+rule_sets = {}
+
+
+def register_rule_set(rule_set):
+    rule_sets[rule_set.name] = rule_set
+    return rule_set
+
+
+def get_rule_set(name):
+    try:
+        return rule_sets[name]
+    except KeyError:
+        raise ValueError('Unknown typography rule set: %r' % (name,))
+
+
+# Spaces, outside of the UNICODE flag \s is only the ASCII white space
+_space = u'[\\s\xa0]'
+
+TEXT_RULES = (
+    Rule(u'\xa0\xa0+', u' ', 'replace more then one special space by a space', needs=(u'\xa0\xa0',)),
+    Rule(u'  +', u' ', 'remove more then one normal space', needs=(u'  ',)),
+    Rule(u'«%s+' % _space, u'«&nbsp;', 'make space non-breaking after «', needs=(u'«',)),
+    Rule(u'%s+»' % _space, u'&nbsp;»', 'make space non-breaking before »', needs=(u'»',)),
+    Rule(u'«([^&])', u'«&nbsp;\g<1>', 'add non-breaking space after «', needs=(u'«',)),
+    Rule(u'([^;])»', u'\g<1>&nbsp;»', 'add non-breaking space before »', needs=(u'»',)),
+    Rule(u'%s+(?=[:;?!%%]|$)' % _space, u'&nbsp;', 'make space non-breaking before :, ?, !, $, %'),
+    Rule(u'(\d)%s+cm' % _space, u'\g<1>&nbsp;cm', 'put non-breaking space before cm', needs=(u'cm',)),
+    Rule(u'(\d)%s+(\d{3})' % _space, u'\g<1>&nbsp;\g<2>',
+         'put non-breaking space between groups in long numbers (ex.: 23 000)'),
+    Rule(u'(%s)P\.%s' % (_space, _space), u'\g<1>P.&nbsp;', 'put non-breaking space after Page abbreviation',
+         needs=(u'P.',)),
+    Rule(u'%sp\.' % _space, u'&nbsp;p.', 'put non-breaking space before page abbreviation', needs=(u'p.',)),
+    Rule(u' -- ', u' — ', 'changed 2 hyphen in a EM dash', needs=(u' -- ',)),
+    Rule(u'&(l|g)t;', u'&amp;\g<1>t;', 'to keep &lt; and &gt; as entities when doing unescape_entities',
+         needs=(u'&lt;', u'&gt;')),
+)
+
+# Superscripts, only for HTML
+SUP_RULES = (
+    Rule(u'(\d)(ème|e|es)([\\s\xa0-])', u'\g<1><sup>\g<2></sup>\g<3>', 'put number extension in exposant (ex. 2e)'),
+    Rule(u'([IVX])e(%s)' % _space, u'\g<1><sup>e</sup>\g<2>', 'put roman number extension in exposant (ex. Xe)'),
+    Rule(u'1er([\\s\xa0-])', u'1<sup>er</sup>\g<1>', 'put 1 extension in exposant (ex. 1er)', needs=(u'1er',)),
+)
+
+HTML_RULES = TEXT_RULES + SUP_RULES
+
+register_rule_set(RuleSet('fr', TEXT_RULES, SUP_RULES, ligatures=True))
+
+register_rule_set(RuleSet('en', (TEXT_RULES[0], TEXT_RULES[1], TEXT_RULES[-1])))
+
+
+# Smart quotes, the same as smartypants 1.6 (quotes, backticks, dashes and
+# ellipses) except the characters are output instead of entities. Escaped
+# characters are output as entities so they're not educated.
+_escapes = (
+    (u'\\\\', u'&#92;'),
+    (u'\\"', u'&#34;'),
+    (u"\\'", u'&#39;'),
+    (u'\\.', u'&#46;'),
+    (u'\\-', u'&#45;'),
+    (u'\\`', u'&#96;'),
+)
+# Tags whose content is kept as is
+_re_skip_tag = re.compile(r'<(/)?(pre|code|kbd|script|math)[^>]*>', re.IGNORECASE)
+_re_non_space = re.compile(r'\S')
+# What's before an opening quote (followed by a word character), as matched
+# by smartypants: in its verbose pattern, the # of the decimal entities starts a
+# comment
+_opening = r'(\s|&nbsp;|--|&[mn]dash;|&&#x201[34];)'
+# What's before a closing quote
+_closing = r'([^ \t\r\n\[\{\(\-])'
+_quotes_rules = tuple((re.compile(pattern), replacement) for pattern, replacement in (
+    (u'"\'(?=\\w)', u'\u201c\u2018'),
+    (u'\'"(?=\\w)', u'\u2018\u201c'),
+    (u"\\b'(?=\\d{2}s)", u'\u2019'),
+    (_opening + u"'(?=\\w)", u'\\1\u2018'),
+    (_closing + u"'(?!\\s|s\\b|\\d)", u'\\1\u2019'),
+    (_closing + u"'(\\s|s\\b)", u'\\1\u2019\\2'),
+    (u"'", u'\u2018'),
+    (_opening + u'"(?=\\w)', u'\\1\u201c'),
+    (u'"(?=\\s)', u'\u201d'),
+    (_closing + u'"', u'\\1\u201d'),
+    (u'"', u'\u201c'),
+))
+
+
+def _educate(text, previous):
+    """
+    Educate a text token, *previous* is the last character of the previous
+    text token (before it was educated).
+    """
+    if '\\' in text:
+        for old, new in _escapes:
+            text = text.replace(old, new)
+    if '--' in text:
+        text = text.replace(u'---', u'\u2013').replace(u'--', u'\u2014')
+    if '.' in text:
+        text = text.replace(u'...', u'\u2026').replace(u'. . .', u'\u2026')
+    if '``' in text or "''" in text:
+        text = text.replace(u'``', u'\u201c').replace(u"''", u'\u201d')
+    if text == u"'":
+        return u'\u2019' if _re_non_space.match(previous) else u'\u2018'
+    if text == u'"':
+        return u'\u201d' if _re_non_space.match(previous) else u'\u201c'
+    if "'" in text or '"' in text:
+        for regex, replacement in _quotes_rules:
+            text = regex.sub(replacement, text)
+    return text
+
+
+class SmartQuotes(object):
+    """
+    Replace straight quotes by curly quotes, -- and --- by em and en dashes
+    and ... by an ellipsis, outside of PRE, CODE, KBD, SCRIPT and MATH tags.
+    The HTML can be given in parts (cut between tokens, see tokens.tokenize),
+    the skipped tags and the last character are kept from part to part.
+    """
+
+    def __init__(self):
+        self.skipped_tags = []
+        self.previous = u''
+
+    def educate(self, text):
+        return self.educate_tokens(tokenize(text))
+
+    def educate_tokens(self, tokens):
+        """
+        Educate the HTML given by its tokens (see tokens.tokenize).
+        """
+        parts = []
+        for kind, value in tokens:
+            if kind == TAG:
+                matches = _re_skip_tag.match(value)
+                if matches and not matches.group(1):
+                    self.skipped_tags.append(matches.group(2).lower())
+                elif matches and self.skipped_tags and matches.group(2).lower() == self.skipped_tags[-1]:
+                    self.skipped_tags.pop()
+                parts.append(value)
+            else:
+                if not self.skipped_tags:
+                    self.previous, value = value[-1], _educate(value, self.previous)
+                else:
+                    self.previous = value[-1]
+                parts.append(value)
+        return u''.join(parts)
+
+
+def smart_quotes(text):
+    """
+    Educate the quotes, dashes and ellipses of the HTML, see SmartQuotes.
+    """
+    return SmartQuotes().educate(text)